@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Benchmark the multi-receipt settlement engine (settlement.py) on synthetic trips.
+Generates random receipts with assignments, shared and unassigned items, then
+times settle() end to end and its array arithmetic on its own.
+"""
+
+import argparse
+import random
+import statistics
+import time
+import settlement
+
+
+def generate_trip(receipts, items, people, seed=0):
+    """Builds `receipts` receipts with `items` line items in total, shared by `people` people."""
+    rng = random.Random(seed)
+    names = [f"person_{index}" for index in range(people)]
+    per_receipt = max(1, items // receipts)
+    trip = []
+    for receipt_index in range(receipts):
+        diners = rng.sample(names, min(len(names), rng.randint(2, 12)))
+        receipt_items, assignments, shared_items, unassigned_items = [], {}, [], []
+        for item_id in range(1, per_receipt + 1):
+            quantity = rng.randint(1, 4)
+            receipt_items.append({"item": f"item_{item_id}", "quantity": quantity, "price": round(rng.uniform(1, 60), 2)})
+            roll = rng.random()
+            if roll < 0.75:
+                # Split the quantity over one or more diners
+                for _ in range(quantity):
+                    assignments.setdefault(rng.choice(diners), []).append({"id": item_id, "quantity": 1})
+            elif roll < 0.95:
+                shared_items.append({"id": item_id, "quantity": quantity})
+            else:
+                unassigned_items.append({"id": item_id, "quantity": quantity})
+        trip.append({
+            "id": f"receipt_{receipt_index}",
+            "items": receipt_items,
+            "assignments": assignments,
+            "shared_items": shared_items,
+            "unassigned_items": unassigned_items,
+            "people": diners,
+            "tax": 8.875,
+            "tip": rng.choice([15, 18, 20, 22]),
+            "paid_by": rng.choice(diners),
+        })
+    return trip
+
+
+def _time(func, repeat):
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        durations.append((time.perf_counter() - started) * 1000)
+    return statistics.median(durations), min(durations)
+
+
+def run(sizes, repeat):
+    print(f"{'receipts':>9} {'items':>7} {'people':>7} {'settle ms (median/min)':>24} {'build_arrays ms':>16} {'transfers':>10}")
+    for receipts, items, people in sizes:
+        trip = generate_trip(receipts, items, people)
+        result = settlement.settle(trip)
+        total_ms = _time(lambda: settlement.settle(trip), repeat)
+        build_ms = _time(lambda: settlement.build_arrays(trip), repeat)
+        print(f"{receipts:>9} {items:>7} {people:>7} {total_ms[0]:>15.2f} / {total_ms[1]:<6.2f} {build_ms[0]:>16.2f} {len(result['transfers']):>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark settlement.settle() on synthetic trips.")
+    parser.add_argument("--repeat", type=int, default=20, help="Timed runs per size")
+    parser.add_argument("--receipts", type=int, help="Benchmark a single size: number of receipts")
+    parser.add_argument("--items", type=int, help="Benchmark a single size: total line items")
+    parser.add_argument("--people", type=int, help="Benchmark a single size: number of people")
+    args = parser.parse_args()
+
+    if args.receipts and args.items and args.people:
+        sizes = [(args.receipts, args.items, args.people)]
+    else:
+        sizes = [(10, 200, 10), (50, 1000, 50), (100, 5000, 200), (500, 20000, 500)]
+    run(sizes, args.repeat)
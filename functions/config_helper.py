@@ -1,5 +1,15 @@
 from firebase_admin import firestore
+from google.api_core import exceptions as api_exceptions
 import logging
+import os
+import threading
+import time
+from deadline import DeadlineExceeded
+
+# How long a fetched configuration stays valid on a warm instance before it is re-read
+CONFIG_CACHE_TTL_SECONDS = float(os.environ.get('CONFIG_CACHE_TTL_SECONDS', '60'))
+# Upper bound on hash-only revalidation, so edits made without updating 'content_hash' still propagate
+CONFIG_FULL_REFRESH_SECONDS = float(os.environ.get('CONFIG_FULL_REFRESH_SECONDS', '600'))
 
 # Default configurations (can be used as fallback if Firestore fetch fails)
 # Updated to reflect provider-specific prompts
@@ -26,7 +36,12 @@ DEFAULT_FALLBACKS = {
 }
 
 
-def get_dynamic_config(service_name):
+def _is_timeout(e):
+    """True if a Firestore read failed because its timeout ran out."""
+    return isinstance(e, (api_exceptions.DeadlineExceeded, api_exceptions.RetryError, TimeoutError))
+
+
+def get_dynamic_config(service_name, timeout=None):
     """Fetch dynamic configuration including selected provider and its specific details (model and prompt).
 
     Fetches model and prompt configurations, determines the selected provider from the model config,
@@ -34,10 +49,16 @@ def get_dynamic_config(service_name):
 
     Args:
         service_name (str): The name of the service ('parse_receipt', 'assign_people_to_items', 'transcribe_audio').
+        timeout (float): Optional timeout in seconds for each Firestore read.
 
     Returns:
-        dict: Configuration containing 'prompt', 'provider_name', 'model', 'max_tokens'.
-              Returns fallback defaults if Firestore fetch fails or data is incomplete.
+        dict: Configuration containing 'prompt', 'provider_name', 'model', 'max_tokens' and, when available,
+              'rate_limits', 'prompt_version' and 'config_hashes' (content hashes of the model and prompt documents).
+              Returns fallback defaults if Firestore fetch fails or data is incomplete; when the fetch failed,
+              the defaults carry 'fallback': True.
+
+    Raises:
+        DeadlineExceeded: If a Firestore read did not finish within `timeout`.
     """
     # Start with defaults for the default provider (usually OpenAI)
     default_provider = DEFAULT_FALLBACKS.get(service_name, {}).get("provider_name", "openai")
@@ -51,10 +72,12 @@ def get_dynamic_config(service_name):
 
         # 1. Fetch model configuration to determine the selected provider
         model_ref = db.collection('configs').document('models').collection(service_name).document('current')
-        model_doc = model_ref.get()
+        model_doc = model_ref.get(timeout=timeout)
 
+        config_hashes = {'models': None, 'prompts': None}
         if model_doc.exists:
             model_data = model_doc.to_dict()
+            config_hashes['models'] = model_data.get('content_hash')
             provider_from_model_config = model_data.get('selected_provider')
             providers_map = model_data.get('providers', {})
 
@@ -64,6 +87,7 @@ def get_dynamic_config(service_name):
                 config['provider_name'] = selected_provider
                 config['model'] = provider_config.get('model_name')
                 config['max_tokens'] = provider_config.get('max_tokens')
+                config['rate_limits'] = provider_config.get('rate_limits') # Optional limiter budgets, see rate_limiter.py
             else:
                 logging.warning(f"Selected provider '{provider_from_model_config}' not found or invalid in model config for {service_name}, using default provider '{selected_provider}'.")
                 # Keep default model details if selected provider is invalid
@@ -79,10 +103,12 @@ def get_dynamic_config(service_name):
 
         # 2. Fetch prompt configuration using the determined selected_provider
         prompt_ref = db.collection('configs').document('prompts').collection(service_name).document('current')
-        prompt_doc = prompt_ref.get()
+        prompt_doc = prompt_ref.get(timeout=timeout)
         prompt_found_for_provider = False
         if prompt_doc.exists:
             prompt_data = prompt_doc.to_dict()
+            config_hashes['prompts'] = prompt_data.get('content_hash')
+            config['prompt_version'] = prompt_data.get('version')
             prompt_providers_map = prompt_data.get('providers', {})
             if selected_provider in prompt_providers_map:
                 provider_prompt_config = prompt_providers_map[selected_provider]
@@ -98,6 +124,7 @@ def get_dynamic_config(service_name):
              prompt_text = DEFAULT_FALLBACKS.get(service_name, {}).get('prompt')
 
         config['prompt'] = prompt_text
+        config['config_hashes'] = config_hashes # Lets get_cached_config revalidate without re-reading prompt texts
 
         # Clean up None prompt for services like transcribe_audio if necessary
         if config['prompt'] is None and service_name == 'transcribe_audio':
@@ -112,6 +139,80 @@ def get_dynamic_config(service_name):
         return config
 
     except Exception as e:
+        if timeout is not None and _is_timeout(e):
+            # Out of request time: running with the placeholder defaults would only produce a wrong answer
+            raise DeadlineExceeded('config') from e
         logging.error(f"Error fetching dynamic configuration for {service_name}: {e}. Returning defaults.")
-        # Return a copy of the defaults for the specific service in case of error
-        return DEFAULT_FALLBACKS.get(service_name, {}).copy() 
\ No newline at end of file
+        # Return a copy of the defaults for the specific service in case of error, marked so callers
+        # do not cache it or report it as a successful fetch
+        config = DEFAULT_FALLBACKS.get(service_name, {}).copy()
+        config['fallback'] = True
+        return config
+
+# --- Per-instance configuration cache ---
+_config_cache = {} # service_name -> (checked_at, config, fetched_at)
+_config_cache_lock = threading.Lock()
+
+
+def get_cached_config(service_name, max_age=None, timeout=None):
+    """Return the dynamic configuration for a service, re-using a recent fetch on this instance.
+
+    Args:
+        service_name (str): The name of the service ('parse_receipt', 'assign_people_to_items', 'transcribe_audio').
+        max_age (float): Maximum age in seconds of a cached entry. Defaults to CONFIG_CACHE_TTL_SECONDS.
+        timeout (float): Optional timeout in seconds for each Firestore read, e.g. from the request deadline.
+
+    Returns:
+        dict: A copy of the configuration, as returned by get_dynamic_config. Fallback defaults returned
+              after a failed fetch are not cached, so the next call reads Firestore again.
+    """
+    max_age = CONFIG_CACHE_TTL_SECONDS if max_age is None else max_age
+    now = time.monotonic()
+    with _config_cache_lock:
+        cached = _config_cache.get(service_name)
+    if cached and now - cached[0] < max_age:
+        return cached[1].copy()
+
+    # An expired entry is still good if the published content hashes have not changed
+    cached_hashes = cached[1].get('config_hashes') if cached else None
+    if (cached_hashes and all(cached_hashes.values()) and now - cached[2] < CONFIG_FULL_REFRESH_SECONDS
+            and fetch_config_hashes(service_name, timeout=timeout) == cached_hashes):
+        with _config_cache_lock:
+            _config_cache[service_name] = (now, cached[1], cached[2])
+        return cached[1].copy()
+
+    config = get_dynamic_config(service_name, timeout=timeout)
+    if config.get('fallback'):
+        return config
+    with _config_cache_lock:
+        _config_cache[service_name] = (now, config, now)
+    return config.copy()
+
+
+def fetch_config_hashes(service_name, timeout=None):
+    """Read only the 'content_hash' field of the model and prompt documents for a service.
+
+    Returns:
+        dict: {'models': hash or None, 'prompts': hash or None}, or None if Firestore could not be read.
+
+    Raises:
+        DeadlineExceeded: If a read did not finish within `timeout`.
+    """
+    try:
+        db = firestore.client()
+        hashes = {}
+        for kind in ('models', 'prompts'):
+            doc = db.collection('configs').document(kind).collection(service_name).document('current').get(field_paths=['content_hash'], timeout=timeout)
+            hashes[kind] = (doc.to_dict() or {}).get('content_hash') if doc.exists else None
+        return hashes
+    except Exception as e:
+        if timeout is not None and _is_timeout(e):
+            raise DeadlineExceeded('config') from e
+        logging.warning(f"Could not read config hashes for {service_name}: {e}")
+        return None
+
+
+def clear_config_cache():
+    """Drop all cached configurations so the next call re-reads Firestore."""
+    with _config_cache_lock:
+        _config_cache.clear()
@@ -0,0 +1,66 @@
+"""Per-request deadlines.
+
+Each handler creates a `Deadline` on entry and passes it down. Every blocking
+step (GCS download, Firestore reads, rate-limiter queueing, provider calls and
+retry backoff) asks it for a timeout, so the steps get shrinking timeouts that
+together stay inside the function's own `timeout_sec`. When too little time is
+left to start a step, `DeadlineExceeded` names that step and the handler
+answers 504 instead of being killed by the platform.
+
+`cancel()` ends a deadline early, e.g. when one of several parallel calls has
+failed. The other calls stop at their next check instead of retrying.
+"""
+
+import os
+import time
+
+# Functions time out at 120s; keep a margin to build and send the response
+REQUEST_DEADLINE_SEC = float(os.environ.get('REQUEST_DEADLINE_SEC', '110'))
+# A step is not started with less time than this left
+MIN_STAGE_SEC = 1.0
+# Firestore reads are small; a read slower than this is stuck, not slow
+FIRESTORE_TIMEOUT_CAP_SEC = 10.0
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a request runs out of time; `stage` names the step that could not finish or start."""
+
+    def __init__(self, stage, message=None):
+        super().__init__(message or f"Request deadline exceeded during '{stage}'.")
+        self.stage = stage
+
+
+class Deadline:
+    """A point in time by which the request must be answered."""
+
+    def __init__(self, seconds=None):
+        self.budget = REQUEST_DEADLINE_SEC if seconds is None else seconds
+        self.expires_at = time.monotonic() + self.budget
+        self.cancelled = False
+
+    def remaining(self):
+        """Seconds left, 0 once expired or cancelled."""
+        if self.cancelled:
+            return 0.0
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def cancel(self):
+        """Expires the deadline now, so cooperating steps stop at their next check."""
+        self.cancelled = True
+
+    def check(self, stage, minimum=MIN_STAGE_SEC):
+        """Raises DeadlineExceeded if fewer than `minimum` seconds are left to start `stage`."""
+        if self.remaining() < minimum:
+            if self.cancelled:
+                raise DeadlineExceeded(stage, f"Request was cancelled before '{stage}'.")
+            raise DeadlineExceeded(stage)
+
+    def timeout(self, stage, cap=None, minimum=MIN_STAGE_SEC):
+        """Returns the timeout in seconds for `stage`: the time left, optionally capped.
+
+        Raises:
+            DeadlineExceeded: If fewer than `minimum` seconds are left.
+        """
+        self.check(stage, minimum)
+        remaining = self.remaining()
+        return min(remaining, cap) if cap is not None else remaining
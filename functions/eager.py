@@ -0,0 +1,219 @@
+"""Results of eager (storage-triggered) parsing and transcription.
+
+The app uploads a receipt image or an audio clip and only then calls the
+matching HTTP function. The `process_upload` storage trigger starts the work
+as soon as the blob is finalized and stores the outcome in one Firestore
+document per blob path (`eager_results/{bucket/blob, URL-encoded}`):
+
+    status:  'pending' | 'done' | 'error'
+    result:  the response 'data' the endpoint returns (when done)
+    error:   error message (when failed)
+
+Both the trigger and the endpoints claim a document in a transaction before
+doing any work, so a blob is processed once whichever side gets there first.
+An endpoint that finds the document pending waits for it for as long as the
+claim is active, up to its own deadline; one that finds it missing, failed or
+abandoned claims it and does the work itself. A document written by the other
+service (e.g. an image URI sent to transcribe_audio) is ignored.
+"""
+
+import datetime
+import os
+import time
+import urllib.parse
+from firebase_admin import firestore
+from deadline import DeadlineExceeded, FIRESTORE_TIMEOUT_CAP_SEC, MIN_STAGE_SEC
+
+RESULTS_COLLECTION = 'eager_results'
+# Blob prefixes the app uploads to, and the service that processes each
+SERVICE_PREFIXES = {
+    'receipts/': 'parse_receipt',
+    'audio_transcriptions/': 'transcribe_audio',
+}
+# How long wait_for_result polls a pending result when the caller has no request deadline
+EAGER_WAIT_SEC = float(os.environ.get('EAGER_WAIT_SEC', '90'))
+# A pending claim older than this belongs to an instance that died or timed out
+PENDING_STALE_SEC = 150
+# Results are only useful for the request that follows the upload; set a TTL policy on 'expire_at' to clean up
+RESULT_TTL = datetime.timedelta(days=1)
+POLL_INTERVAL_SEC = 0.25
+MAX_POLL_INTERVAL_SEC = 1.0
+
+
+def service_for_blob(blob_name):
+    """Returns the service that eagerly processes a blob, or None if its prefix is not handled."""
+    for prefix, service_name in SERVICE_PREFIXES.items():
+        if blob_name.startswith(prefix):
+            return service_name
+    return None
+
+
+def _result_ref(bucket_name, blob_name):
+    # Blob paths contain '/', which Firestore document IDs may not
+    doc_id = urllib.parse.quote(f"{bucket_name}/{blob_name}", safe='')
+    return firestore.client().collection(RESULTS_COLLECTION).document(doc_id)
+
+
+def _is_stale(record):
+    started_at = record.get('started_at')
+    if started_at is None:
+        return True
+    return (datetime.datetime.now(datetime.timezone.utc) - started_at).total_seconds() > PENDING_STALE_SEC
+
+
+def _other_service(record, service_name):
+    return record is not None and record.get('service') not in (None, service_name)
+
+
+def _should_process(record, generation, service_name):
+    """Decides whether a claimant should (re)do the work given the current document, if any."""
+    if _other_service(record, service_name):
+        return False # Owned by the other service; never overwrite it
+    if record is None or record.get('status') == 'error':
+        return True
+    if generation is not None and record.get('generation') not in (None, generation):
+        return True # The blob was overwritten since this result was produced
+    if record.get('status') == 'pending':
+        return _is_stale(record)
+    return False
+
+
+def claim(service_name, bucket_name, blob_name, generation=None, source='request', timeout=None):
+    """Marks a blob as being processed unless it is already done or in progress elsewhere.
+
+    Args:
+        service_name (str): 'parse_receipt' or 'transcribe_audio'.
+        bucket_name (str): Bucket of the uploaded blob.
+        blob_name (str): Path of the uploaded blob.
+        generation (str): Blob generation from the storage event, if known.
+        source (str): 'trigger' or 'request', recorded for monitoring.
+        timeout (float): Optional timeout in seconds for the transaction's read, e.g. from the request deadline.
+
+    Returns:
+        tuple: (claimed, record). claimed is True if the caller should do the work; record is the
+        document as it was before the claim (None if it did not exist).
+    """
+    ref = _result_ref(bucket_name, blob_name)
+
+    @firestore.transactional
+    def claim_in_transaction(transaction):
+        snapshot = ref.get(transaction=transaction, timeout=timeout)
+        record = snapshot.to_dict() if snapshot.exists else None
+        if not _should_process(record, generation, service_name):
+            return False, record
+        now = datetime.datetime.now(datetime.timezone.utc)
+        transaction.set(ref, {
+            'service': service_name,
+            'bucket': bucket_name,
+            'blob': blob_name,
+            'generation': generation,
+            'status': 'pending',
+            'source': source,
+            'started_at': now,
+            'updated_at': now,
+            'expire_at': now + RESULT_TTL,
+        })
+        return True, record
+
+    return claim_in_transaction(firestore.client().transaction())
+
+
+def _update(bucket_name, blob_name, fields):
+    try:
+        _result_ref(bucket_name, blob_name).update({**fields, 'updated_at': firestore.SERVER_TIMESTAMP})
+    except Exception as e:
+        # A pending claim left behind goes stale and is taken over, so this is not fatal
+        print(f"Warning: could not store eager result for {blob_name}: {e}")
+
+
+def complete(bucket_name, blob_name, result):
+    """Stores the response data for a processed blob. Never raises."""
+    _update(bucket_name, blob_name, {'status': 'done', 'result': result})
+
+
+def fail(bucket_name, blob_name, error):
+    """Records a failure, so the next endpoint call retries instead of waiting. Never raises."""
+    _update(bucket_name, blob_name, {'status': 'error', 'error': f"{type(error).__name__}: {error}"})
+
+
+def wait_for_result(bucket_name, blob_name, timeout=None):
+    """Polls a pending document until it settles.
+
+    Each poll's read gets the time left of the wait (at most FIRESTORE_TIMEOUT_CAP_SEC) as its timeout.
+
+    Returns:
+        dict or None: The document once it is no longer pending or has gone stale, the still pending
+        document after timeout (default EAGER_WAIT_SEC), or None if it disappeared.
+    """
+    ref = _result_ref(bucket_name, blob_name)
+    deadline = time.monotonic() + (EAGER_WAIT_SEC if timeout is None else timeout)
+    interval = POLL_INTERVAL_SEC
+    while True:
+        read_timeout = min(max(deadline - time.monotonic(), MIN_STAGE_SEC), FIRESTORE_TIMEOUT_CAP_SEC)
+        snapshot = ref.get(timeout=read_timeout)
+        if not snapshot.exists:
+            return None
+        record = snapshot.to_dict()
+        if record.get('status') != 'pending' or _is_stale(record) or time.monotonic() + interval > deadline:
+            return record
+        time.sleep(interval)
+        interval = min(interval * 2, MAX_POLL_INTERVAL_SEC)
+
+
+def get_or_claim(service_name, bucket_name, blob_name, deadline=None):
+    """Used by the endpoints: returns a stored result, waiting on a pending one, or claims the blob.
+
+    A pending claim that is still active is waited for until the request deadline, since redoing the work
+    with the little time left after a long wait would rarely finish. Bookkeeping failures never fail the
+    request; the endpoint then simply does the work itself.
+
+    Args:
+        deadline (Deadline): The request deadline bounding the wait. Without one, the wait is EAGER_WAIT_SEC.
+
+    Returns:
+        tuple: (result, claimed). result is the stored response data if the blob was already
+        processed, else None. claimed is True if the caller now owns the document and should
+        report its outcome with complete() or fail().
+
+    Raises:
+        DeadlineExceeded: If the deadline ran out while another instance was still processing the blob.
+    """
+    def read_timeout(stage):
+        return None if deadline is None else deadline.timeout(stage, cap=FIRESTORE_TIMEOUT_CAP_SEC)
+
+    try:
+        claimed, record = claim(service_name, bucket_name, blob_name, timeout=read_timeout('eager result lookup'))
+        if claimed:
+            return None, True
+        if _other_service(record, service_name):
+            print(f"Eager result for {blob_name} belongs to {record.get('service')}, processing in this request.")
+            return None, False
+        if record.get('status') == 'done':
+            print(f"Eager result found for {blob_name} (source: {record.get('source')}).")
+            return record.get('result'), False
+
+        max_wait = EAGER_WAIT_SEC if deadline is None else deadline.remaining() - MIN_STAGE_SEC
+        print(f"Eager processing of {blob_name} in progress, waiting up to {max_wait:.0f}s...")
+        started = time.monotonic()
+        record = wait_for_result(bucket_name, blob_name, timeout=max_wait)
+        waited = time.monotonic() - started
+    except Exception as e:
+        print(f"Warning: eager result lookup failed for {blob_name}, processing in this request: {e}")
+        return None, False
+
+    if record and record.get('status') == 'done':
+        print(f"Eager result for {blob_name} ready after waiting {waited:.2f}s.")
+        return record.get('result'), False
+    if deadline is not None and record and record.get('status') == 'pending' and not _is_stale(record):
+        # Still being processed elsewhere; its result is stored for the client's retry
+        raise DeadlineExceeded('eager result wait')
+    print(f"Eager result for {blob_name} not available after {waited:.2f}s, processing in this request.")
+    try:
+        # Take over a failed or stale claim so this request's outcome is stored for the next caller
+        claimed, record = claim(service_name, bucket_name, blob_name, timeout=read_timeout('eager result claim'))
+    except Exception as e:
+        print(f"Warning: could not claim {blob_name}, processing in this request: {e}")
+        return None, False
+    if not claimed and record and record.get('status') == 'done' and not _other_service(record, service_name):
+        return record.get('result'), False
+    return None, claimed
@@ -0,0 +1,262 @@
+"""Incremental re-assignment for edited transcriptions.
+
+When the user fixes a name or records an extra sentence, only the people and
+receipt items touched by the edit need to be re-assigned. This module diffs the
+old and new transcription at sentence level, works out the affected slice of
+the previous AssignmentResult, builds a prompt for just that slice (with the
+remaining assignments as fixed context) and merges the provider's answer back.
+"""
+
+import difflib
+import json
+import re
+from models import AssignedItemRef, PersonAssignment, AssignmentResult
+
+# Re-assign the whole receipt instead when the edit touches more than this share of the items
+INCREMENTAL_MAX_ITEM_FRACTION = 0.5
+
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+|\n+")
+_WORD = re.compile(r"[a-z0-9']+")
+_ITEM_NUMBER = re.compile(r"(?:\bitem|\bnumber|\bno\.?|#)\s*(\d+)", re.IGNORECASE)
+_STOPWORDS = {"the", "and", "with", "for", "of", "a", "an", "in", "on", "side", "extra", "add"}
+
+
+def result_from_response(result_dict):
+    """Builds an AssignmentResult from the response format returned to the app ('assignments' keyed by name).
+
+    Raises:
+        ValueError: If result_dict is not an object or its 'assignments' is not keyed by person name.
+        pydantic.ValidationError: If the entries do not match the assignment models.
+    """
+    if not isinstance(result_dict, dict):
+        raise ValueError("Invalid request: 'previous_result' must be an object.")
+    if 'person_assignments' in result_dict:
+        return AssignmentResult.model_validate(result_dict)
+    assignments = result_dict.get('assignments') or {}
+    if not isinstance(assignments, dict):
+        raise ValueError("Invalid request: 'previous_result.assignments' must map person names to item lists.")
+    return AssignmentResult.model_validate({
+        "person_assignments": [
+            {"person_name": name, "items": items} for name, items in assignments.items()
+        ],
+        "shared_items": result_dict.get('shared_items') or [],
+        "unassigned_items": result_dict.get('unassigned_items') or [],
+    })
+
+
+def _sentences(text):
+    return [sentence.strip() for sentence in _SENTENCE_SPLIT.split(text or "") if sentence.strip()]
+
+
+def changed_sentences(previous_transcription, transcription):
+    """Diffs two transcriptions at sentence level.
+
+    Returns:
+        tuple: (removed, added, unchanged, preceding). removed and added are the changed sentences;
+        unchanged holds (index, sentence) pairs of the edited transcription's untouched sentences; preceding
+        is the set of indexes of the sentences right before each edit, which pronouns in the edit ("she also
+        had the fries") refer back to.
+    """
+    old, new = _sentences(previous_transcription), _sentences(transcription)
+    removed, added, unchanged, preceding = [], [], [], set()
+    matcher = difflib.SequenceMatcher(a=old, b=new, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            unchanged.extend((index, new[index]) for index in range(j1, j2))
+            continue
+        removed.extend(old[i1:i2])
+        added.extend(new[j1:j2])
+        if j1 > 0:
+            preceding.add(j1 - 1)
+    return removed, added, unchanged, preceding
+
+
+def _item_words(name):
+    return {word for word in _WORD.findall(name.lower()) if len(word) >= 3 and word not in _STOPWORDS}
+
+
+def _names(name, text):
+    """True if `text` mentions the person `name` as a whole word."""
+    return re.search(rf"\b{re.escape(name.lower())}\b", text.lower()) is not None
+
+
+def _mentioned_items(items_by_id, text):
+    """Ids of the receipt items `text` refers to, by item number or by a word of the item name."""
+    words = set(_WORD.findall(text.lower()))
+    numbers = {int(number) for number in _ITEM_NUMBER.findall(text)}
+    return {
+        item_id for item_id, item in items_by_id.items()
+        if item_id in numbers or _item_words(str(item.get('item', ''))) & words
+    }
+
+
+def _items_by_id(receipt_items):
+    """Returns {id: item} for the receipt items, or None if any item lacks a unique integer 'id'."""
+    items_by_id = {}
+    for item in receipt_items:
+        try:
+            item_id = int(item['id'])
+        except (KeyError, TypeError, ValueError):
+            return None
+        if item_id in items_by_id:
+            return None
+        items_by_id[item_id] = item
+    return items_by_id
+
+
+def plan_update(previous_result, previous_transcription, transcription, receipt_items):
+    """Works out which part of the previous assignment an edit can affect.
+
+    Args:
+        previous_result (AssignmentResult): The assignment returned for previous_transcription.
+        previous_transcription (str): The transcription that produced previous_result.
+        transcription (str): The edited transcription.
+        receipt_items (list): Receipt items as sent by the app (dicts with 'id', 'item', 'quantity', 'price').
+
+    Returns:
+        dict or None: None when the whole receipt should be re-assigned. Otherwise a plan with
+        'changed_text', 'removed_text', 'context_text' (unchanged sentences about the open items and
+        affected people), 'people' (names the edit mentions), 'items' (the open receipt slice with remaining
+        quantities), 'fixed' (assignments kept as context for the open items) and 'unchanged' (True
+        when the edit did not change any sentence).
+    """
+    items_by_id = _items_by_id(receipt_items)
+    if items_by_id is None:
+        # Without item ids the previous result cannot be matched to the receipt
+        print("Incremental assignment: receipt items have no unique 'id', re-assigning everything.")
+        return None
+    held = {}
+    refs = [ref for assignment in previous_result.person_assignments for ref in assignment.items]
+    for ref in refs + previous_result.shared_items + previous_result.unassigned_items:
+        held[ref.id] = held.get(ref.id, 0) + ref.quantity
+    if held != {item_id: int(item.get('quantity', 0)) for item_id, item in items_by_id.items()}:
+        # The receipt itself was edited since the previous assignment
+        print("Incremental assignment: previous result does not match the receipt items, re-assigning everything.")
+        return None
+
+    removed, added, unchanged, preceding = changed_sentences(previous_transcription, transcription)
+    if not removed and not added:
+        return {"unchanged": True}
+
+    changed_text = " ".join(removed + added)
+    people = [assignment.person_name for assignment in previous_result.person_assignments]
+    affected_people = {name for name in people if _names(name, changed_text)}
+    # Only items the edit itself mentions are re-opened; whatever else a named person holds stays theirs,
+    # since the sentences assigning it did not change
+    affected_ids = _mentioned_items(items_by_id, changed_text)
+
+    if not affected_ids:
+        print("Incremental assignment: edit did not match any receipt item, re-assigning everything.")
+        return None
+    if len(affected_ids) > INCREMENTAL_MAX_ITEM_FRACTION * len(items_by_id):
+        print(f"Incremental assignment: edit touches {len(affected_ids)}/{len(items_by_id)} items, re-assigning everything.")
+        return None
+
+    # Unchanged sentences the model needs: the ones right before an edit (pronouns) and the ones naming an
+    # open item or an affected person (e.g. the rest of what a renamed person had)
+    context = [
+        sentence for index, sentence in unchanged
+        if index in preceding or _mentioned_items(items_by_id, sentence) & affected_ids
+        or any(_names(name, sentence) for name in affected_people)
+    ]
+
+    # Quantities held by unaffected people stay fixed; only the remainder is open
+    fixed = []
+    fixed_quantity = {}
+    for assignment in previous_result.person_assignments:
+        if assignment.person_name in affected_people:
+            continue
+        for ref in assignment.items:
+            if ref.id in affected_ids:
+                fixed.append({"person_name": assignment.person_name, "id": ref.id, "quantity": ref.quantity})
+                fixed_quantity[ref.id] = fixed_quantity.get(ref.id, 0) + ref.quantity
+
+    open_items = []
+    for item_id in sorted(affected_ids):
+        item = dict(items_by_id[item_id])
+        item['quantity'] = int(item.get('quantity', 0)) - fixed_quantity.get(item_id, 0)
+        if item['quantity'] > 0:
+            open_items.append(item)
+
+    return {
+        "unchanged": False,
+        "changed_text": "\n".join(added),
+        "removed_text": "\n".join(removed),
+        "context_text": "\n".join(context),
+        "people": sorted(affected_people),
+        "all_people": people,
+        "items": open_items,
+        "fixed": fixed,
+    }
+
+
+def build_prompt(plan):
+    """Builds the request content for re-assigning only the slice described by plan.
+
+    The assignment prompt template is sent separately, unchanged, as the static instructions.
+    """
+    return (
+        "**Incremental update:** The transcription was edited. Only the receipt items listed below are open for "
+        "assignment, and their quantities are what remains after the fixed assignments. Assign every open item "
+        "using the changed transcription text; include every person the changed text mentions. Do not output "
+        "items that are not listed below.\n\n"
+        f"People already on this receipt: {json.dumps(plan['all_people'])}\n\n"
+        f"Removed transcription text:\n{plan['removed_text'] or '(none)'}\n\n"
+        f"Changed transcription text:\n{plan['changed_text'] or '(none)'}\n\n"
+        f"Unchanged transcription text about these items and people (context):\n{plan['context_text'] or '(none)'}\n\n"
+        f"Fixed assignments (do not change):\n{json.dumps(plan['fixed'])}\n\n"
+        f"Receipt Items JSON:\n{json.dumps(plan['items'])}"
+    )
+
+
+def merge_update(previous_result, plan, slice_result):
+    """Merges the provider's answer for the open slice into the previous assignment.
+
+    Returns:
+        AssignmentResult or None: None if the slice answer over-assigns an item, in which case the
+        caller should re-assign the whole receipt.
+    """
+    open_quantity = {int(item['id']): int(item['quantity']) for item in plan['items']}
+    affected_people = set(plan['people'])
+
+    # Check the slice stays within the open quantities; anything left over becomes unassigned
+    assigned = {}
+    refs = [ref for assignment in slice_result.person_assignments for ref in assignment.items]
+    refs += slice_result.shared_items + slice_result.unassigned_items
+    for ref in refs:
+        if ref.id in open_quantity:
+            assigned[ref.id] = assigned.get(ref.id, 0) + ref.quantity
+    for item_id, quantity in assigned.items():
+        if quantity > open_quantity[item_id]:
+            print(f"Incremental assignment over-assigned item {item_id} ({quantity} > {open_quantity[item_id]}).")
+            return None
+
+    def keep(refs):
+        return [ref for ref in refs if ref.id in open_quantity]
+
+    # Start from the previous result without what the affected people held of the open items, and without
+    # the open items' shared/unassigned entries; everything else they held is kept
+    merged = {}
+    for assignment in previous_result.person_assignments:
+        released = assignment.person_name in affected_people
+        merged[assignment.person_name] = [
+            ref for ref in assignment.items if not (released and ref.id in open_quantity)
+        ]
+    for assignment in slice_result.person_assignments:
+        merged.setdefault(assignment.person_name, []).extend(keep(assignment.items))
+    merged = {name: items for name, items in merged.items() if items}
+
+    shared_items = [ref for ref in previous_result.shared_items if ref.id not in open_quantity]
+    shared_items += keep(slice_result.shared_items)
+    unassigned_items = [ref for ref in previous_result.unassigned_items if ref.id not in open_quantity]
+    unassigned_items += keep(slice_result.unassigned_items)
+    for item_id, quantity in open_quantity.items():
+        remainder = quantity - assigned.get(item_id, 0)
+        if remainder > 0:
+            unassigned_items.append(AssignedItemRef(id=item_id, quantity=remainder))
+
+    return AssignmentResult(
+        person_assignments=[PersonAssignment(person_name=name, items=items) for name, items in merged.items()],
+        shared_items=shared_items,
+        unassigned_items=unassigned_items,
+    )
@@ -9,6 +9,9 @@ import firebase_admin
 from firebase_admin import credentials, firestore
 import datetime
 import argparse
+import difflib
+import hashlib
+import json
 import os
 
 # Default configurations structure with provider support for prompts and models
@@ -62,11 +65,13 @@ Return *only* the JSON object."""}
             "providers": {
                 "openai": {
                     "model_name": "gpt-4o",
-                    "max_tokens": 4096
+                    "max_tokens": 4096,
+                    "rate_limits": {"requests_per_minute": 500, "tokens_per_minute": 30000, "max_queue_wait_sec": 20, "max_retries": 3}
                 },
                 "gemini": {
                     "model_name": "gemini-1.5-flash",
-                    "max_tokens": 8192
+                    "max_tokens": 8192,
+                    "rate_limits": {"requests_per_minute": 1000, "tokens_per_minute": 1000000, "max_queue_wait_sec": 20, "max_retries": 3}
                 }
             }
         }
@@ -138,11 +143,13 @@ Return *only* the JSON object."""}
             "providers": {
                 "openai": {
                     "model_name": "gpt-4o",
-                    "max_tokens": 4096
+                    "max_tokens": 4096,
+                    "rate_limits": {"requests_per_minute": 500, "tokens_per_minute": 30000, "max_queue_wait_sec": 20, "max_retries": 3}
                 },
                 "gemini": {
                     "model_name": "gemini-1.5-flash",
-                    "max_tokens": 8192
+                    "max_tokens": 8192,
+                    "rate_limits": {"requests_per_minute": 1000, "tokens_per_minute": 1000000, "max_queue_wait_sec": 20, "max_retries": 3}
                 }
             }
         }
@@ -157,23 +164,59 @@ Return *only* the JSON object."""}
             "providers": {
                 "openai": {
                     "model_name": "whisper-1",
-                    "max_tokens": None
+                    "max_tokens": None,
+                    "rate_limits": {"requests_per_minute": 500, "max_queue_wait_sec": 20, "max_retries": 3}
                 },
                 "gemini": {
                     "model_name": "gemini-1.5-flash",
-                    "max_tokens": None
+                    "max_tokens": None,
+                    "rate_limits": {"requests_per_minute": 1000, "tokens_per_minute": 1000000, "max_queue_wait_sec": 20, "max_retries": 3}
                 }
             }
         }
     }
 }
 
-def initialize_firestore_config(cred_path=None, admin_uid="admin"):
-    """Initialize Firestore with default configurations supporting multiple providers for prompts and models.
+def content_hash(content):
+    """Returns a stable SHA-256 hash of a config document's content fields."""
+    canonical = json.dumps(content, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _desired_documents(db):
+    """Yields (label, document reference, content) for every config document the defaults define."""
+    for service_name, service_data in DEFAULT_CONFIGS.items():
+        prompt_ref = db.collection("configs").document("prompts").collection(service_name).document("current")
+        yield f"prompts/{service_name}", prompt_ref, {
+            "providers": service_data["prompts"] # Store the whole prompts map
+        }
+        model_config = service_data["model_config"]
+        model_ref = db.collection("configs").document("models").collection(service_name).document("current")
+        yield f"models/{service_name}", model_ref, {
+            "selected_provider": model_config["default_selected_provider"],
+            "providers": model_config["providers"]
+        }
+
+
+def _print_diff(label, current_content, desired_content):
+    """Prints a unified diff between the stored and the desired content of one document."""
+    current_lines = json.dumps(current_content, indent=2, sort_keys=True, default=str).splitlines() if current_content is not None else []
+    desired_lines = json.dumps(desired_content, indent=2, sort_keys=True, default=str).splitlines()
+    for line in difflib.unified_diff(current_lines, desired_lines, fromfile=f"{label} (current)", tofile=f"{label} (new)", lineterm=""):
+        print(line)
+
+
+def initialize_firestore_config(cred_path=None, admin_uid="admin", dry_run=False):
+    """Publish the default configurations to Firestore, writing only the documents that changed.
+
+    Reads the current prompt and model documents, compares their content with DEFAULT_CONFIGS by hash and
+    commits the changed ones in a single WriteBatch. Each written document gets a monotonically increasing
+    'version' and a 'content_hash' that running instances can check instead of re-reading full prompt texts.
 
     Args:
         cred_path (str): Path to the Firebase credentials JSON file
         admin_uid (str): Admin user ID to associate with the configurations
+        dry_run (bool): Print the diff without writing anything
     """
     # Check if Firebase already initialized
     try:
@@ -193,45 +236,59 @@ def initialize_firestore_config(cred_path=None, admin_uid="admin"):
     db = firestore.client()
     timestamp = datetime.datetime.now(datetime.timezone.utc) # Use timezone-aware timestamp
 
-    # Initialize configurations for each service
-    for service_name, service_data in DEFAULT_CONFIGS.items(): # Iterate through service data
-        try:
-            # Create/Update prompt document with providers map
-            prompt_ref = db.collection("configs").document("prompts").collection(service_name).document("current")
-            prompt_config_data = {
-                "providers": service_data["prompts"], # Store the whole prompts map
-                "version": 1,
-                "last_updated": timestamp,
-                "created_by": admin_uid
-            }
-            prompt_ref.set(prompt_config_data) # Removed merge=True to ensure overwrite
-            print(f"Set prompt configuration for {service_name}")
-
-            # Create/Update model document with new structure
-            model_ref = db.collection("configs").document("models").collection(service_name).document("current")
-            # Extract model config part from service_data
-            model_config = service_data["model_config"]
-            model_firestore_data = {
-                "selected_provider": model_config["default_selected_provider"],
-                "providers": model_config["providers"],
-                "version": 1,
-                "last_updated": timestamp,
-                "created_by": admin_uid
-            }
+    desired = list(_desired_documents(db))
+    # Read every current document in one round trip
+    snapshots = {snapshot.reference.path: snapshot for snapshot in db.get_all([ref for _, ref, _ in desired])}
 
-            model_ref.set(model_firestore_data) # Removed merge=True to ensure overwrite
-            print(f"Set model configuration for {service_name}")
+    batch = db.batch()
+    changed = 0
+    for label, ref, content in desired:
+        snapshot = snapshots.get(ref.path)
+        current = snapshot.to_dict() if snapshot is not None and snapshot.exists else None
+        new_hash = content_hash(content)
+        if current is not None:
+            current_content = {key: current.get(key) for key in content}
+            # Compare the actual content: console edits change it without updating the stored 'content_hash'
+            if content_hash(current_content) == new_hash:
+                if current.get("content_hash") == new_hash:
+                    print(f"Unchanged: {label} (version {current.get('version')})")
+                else:
+                    # Missing or out-of-date stored hash; fix it so instances revalidate against the right value
+                    print(f"Rehash: {label} (version {current.get('version')}, content unchanged)")
+                    batch.update(ref, {"content_hash": new_hash})
+                    changed += 1
+                continue
+            if current.get("content_hash") == new_hash:
+                print(f"Note: {label} was edited without updating its content_hash.")
+        else:
+            current_content = None
 
-        except Exception as e:
-            print(f"!!! ERROR setting configuration for {service_name}: {e}") # Added error printing
+        version = int((current or {}).get("version") or 0) + 1
+        print(f"{'Create' if current is None else 'Update'}: {label} -> version {version}")
+        _print_diff(label, current_content, content)
+        batch.set(ref, {
+            **content,
+            "version": version,
+            "content_hash": new_hash,
+            "last_updated": timestamp,
+            "created_by": admin_uid
+        })
+        changed += 1
 
-    print("\nFirestore configuration initialization/update complete!")
-    print("You can now manage provider-specific prompts and models in Firestore.")
+    if not changed:
+        print("\nFirestore configuration is already up to date; nothing to write.")
+    elif dry_run:
+        print(f"\nDry run: {changed} document(s) would be written.")
+    else:
+        batch.commit()
+        print(f"\nFirestore configuration update complete: {changed} document(s) written in one batch.")
+        print("You can now manage provider-specific prompts and models in Firestore.")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Initialize Firestore with default configurations for dynamic prompts and models (multi-provider).")
     parser.add_argument("--admin-uid", default="admin_script", help="Admin user ID to associate with the configurations") # Changed default
     parser.add_argument("--cred-path", help="Path to the Firebase service account credentials JSON file (optional, uses GOOGLE_APPLICATION_CREDENTIALS otherwise)")
+    parser.add_argument("--dry-run", action="store_true", help="Print the diff against Firestore without writing anything")
     args = parser.parse_args()
 
-    initialize_firestore_config(cred_path=args.cred_path, admin_uid=args.admin_uid) 
\ No newline at end of file
+    initialize_firestore_config(cred_path=args.cred_path, admin_uid=args.admin_uid, dry_run=args.dry_run)
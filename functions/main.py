@@ -2,63 +2,63 @@
 # To get started, simply uncomment the below code or create your own.
 # Deploy with `firebase deploy`
 
-from firebase_functions import https_fn, options
-from firebase_admin import initialize_app, storage # Import storage
+import time
+_MODULE_LOAD_STARTED = time.perf_counter() # Measures SDK import cost for warm-up reporting
+
+from firebase_functions import https_fn, storage_fn, options
+from firebase_admin import storage # Import storage
 from google.cloud import storage as gcs # Import Google Cloud Storage client library
-from openai import OpenAI
-# Import the two libraries with distinct aliases
-from google import genai as genai_legacy # Older library for parse/assign
-import google.generativeai as genai_new # Newer library for transcribe
-# Keep instructor for OpenAI
-import instructor 
-import base64
+from google.cloud.storage.retry import DEFAULT_RETRY
+from google.api_core import exceptions as api_exceptions
+import requests
 import json
 import os
 import re # Import regex for parsing URI
 import tempfile # Needed for downloading files
+import wave # Audio duration for the usage ledger
 import mimetypes # Needed for Gemini file uploads
-# Import types from both libraries with distinct aliases
-from google.genai import types as genai_legacy_types # For legacy client
-from google.generativeai import types as genai_new_types # For newer client (if needed)
-from pydantic import BaseModel, Field, ValidationError
-from typing import List, Union, Dict, Any, Optional
+from pydantic import ValidationError
 import traceback # Keep for error logging
-from config_helper import get_dynamic_config # Import the config helper
+from config_helper import get_cached_config # Import the config helper
+from models import ReceiptData, AssignmentResult, TranscriptionResult, ReceiptCorrections
+import providers # OpenAI/Gemini adapters (single google.genai SDK for Gemini)
+import eager # Results of storage-triggered processing
+import warmup
+import incremental
+import rate_limiter
+import tiling
+import reconcile
+import settlement
+from deadline import Deadline, DeadlineExceeded, FIRESTORE_TIMEOUT_CAP_SEC, MIN_STAGE_SEC
 
 # Initialize Firebase Admin SDK
-initialize_app()
-
-# --- Pydantic Models (Keep as is) ---
-class ReceiptItem(BaseModel):
-    item: str
-    quantity: int
-    price: float
-
-class ReceiptData(BaseModel):
-    items: List[ReceiptItem]
-    subtotal: float
-
-class AssignedItemRef(BaseModel): # Updated Assignment Model for simplicity
-    id: int
-    quantity: int
-
-class PersonAssignment(BaseModel):
-    person_name: str
-    items: List[AssignedItemRef]
+warmup.ensure_firebase_app()
 
-class AssignmentResult(BaseModel):
-    person_assignments: List[PersonAssignment] # List of person assignments instead of Dict
-    shared_items: List[AssignedItemRef]
-    unassigned_items: List[AssignedItemRef]
-    # Removed people list - can be derived from assignments keys
+_IMPORT_SECONDS = time.perf_counter() - _MODULE_LOAD_STARTED
 
-class TranscriptionResult(BaseModel):
-    text: str
+# On min-instance startup, prepare this service's state before the first request arrives.
+# K_SERVICE is only set on the deployed runtime, so deploy-time code analysis is unaffected.
+if os.environ.get('WARM_UP_ON_START') and os.environ.get('K_SERVICE'):
+    _service = os.environ['K_SERVICE'].replace('-', '_')
+    warmup.warm_up_in_background(
+        services=(_service,) if _service in warmup.SERVICES else warmup.SERVICES,
+        import_seconds=_IMPORT_SECONDS
+    )
 
 # --- Helper Functions ---
 
-def _download_blob_to_tempfile(bucket_name, blob_name):
-    """Downloads a blob to a temporary file and returns its path."""
+def _warmup_response(req, service_name):
+    """Returns a warm-up response if the request is a warm-up ping ({"data": {"warmup": true}}), else None."""
+    request_json = req.get_json(silent=True) or {}
+    data = request_json.get('data') if isinstance(request_json, dict) else None
+    if not isinstance(data, dict) or not data.get('warmup'):
+        return None
+    print(f"Warm-up request received for {service_name}.")
+    timings = warmup.warm_up(services=(service_name,), import_seconds=_IMPORT_SECONDS)
+    return {"data": {"warmed_up": 'errors' not in timings, "timings_ms": timings}}
+
+def _download_blob_to_tempfile(bucket_name, blob_name, deadline=None):
+    """Downloads a blob to a temporary file and returns its path, within the request deadline if given."""
     storage_client = gcs.Client()
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(blob_name)
@@ -72,34 +72,200 @@ def _download_blob_to_tempfile(bucket_name, blob_name):
     os.close(temp_fd) # Close the file descriptor, we only need the path
 
     print(f"Downloading gs://{bucket_name}/{blob_name} to {temp_local_filename}")
-    blob.download_to_filename(temp_local_filename)
+    download_kwargs = {}
+    if deadline:
+        # Bound both each HTTP attempt and the retries around them; GCS retries for up to 120s by default
+        timeout = deadline.timeout('download')
+        download_kwargs = {"timeout": timeout, "retry": DEFAULT_RETRY.with_deadline(timeout)}
+    try:
+        blob.download_to_filename(temp_local_filename, **download_kwargs)
+    except Exception as e:
+        os.remove(temp_local_filename)
+        timed_out = isinstance(e, (requests.exceptions.Timeout, api_exceptions.RetryError))
+        if deadline and (timed_out or deadline.remaining() < MIN_STAGE_SEC):
+            raise DeadlineExceeded('download') from e
+        raise
     print("Download complete.")
     return temp_local_filename
 
-def _validate_data(data: dict, model: BaseModel):
-    """Validates dictionary data against a Pydantic model."""
+def _audio_duration_seconds(path):
+    """Returns the duration of a WAV file in seconds, or None for other formats."""
     try:
-        validated_data = model.model_validate(data)
-        return validated_data
-    except ValidationError as e:
-        print(f"Pydantic validation failed: {e}")
-        print(f"Data being validated: {data}")
-        raise ValueError(f"Output validation failed: {e}") from e
-
-def _parse_json_from_response(text: str, model: BaseModel):
-    """Attempts to parse JSON from text, handling potential markdown/text noise."""
+        with wave.open(path, "rb") as wav_file:
+            return wav_file.getnframes() / float(wav_file.getframerate())
+    except (wave.Error, EOFError, OSError, ZeroDivisionError):
+        return None
+
+def _assignment_response(assignment_result):
+    """Converts an AssignmentResult to the response format expected by the frontend."""
+    # Convert from new format to old format for backward compatibility
+    result_dict = assignment_result.model_dump()
+    assignments_dict = {}
+    for person_assignment in result_dict['person_assignments']:
+        person_name = person_assignment['person_name']
+        assignments_dict[person_name] = person_assignment['items']
+    result_dict['assignments'] = assignments_dict
+    del result_dict['person_assignments']
+    return {"data": result_dict}
+
+def _rate_limited_response(e):
+    """Builds a 429 response for a call the rate limiter could not admit, with a Retry-After hint."""
+    retry_after = max(int(e.retry_after or 1), 1)
+    return {"error": {"message": f"{type(e).__name__}: {e}", "status": 429}}, 429, {"Retry-After": str(retry_after)}
+
+def _deadline_response(e):
+    """Builds a 504 response naming the stage that ran out of time."""
+    return {"error": {"message": f"{type(e).__name__}: {e}", "status": 504, "stage": e.stage}}, 504
+
+def _parse_uri(uri, field_name):
+    """Splits a gs:// URI into (bucket_name, blob_name)."""
+    match = re.match(r"gs://([^/]+)/(.+)", uri)
+    if not match:
+        raise ValueError(f"Invalid request: '{field_name}' must be a valid gs:// URI.")
+    bucket_name, blob_name = match.groups()
+    print(f"Parsed URI: Bucket='{bucket_name}', Blob='{blob_name}'")
+    return bucket_name, blob_name
+
+# --- Processing (shared by the HTTP endpoints and the storage trigger) ---
+
+def _parse_receipt_blob(bucket_name, blob_name, deadline):
+    """Gets config, downloads the receipt image and parses it with the selected provider. Returns the response data."""
+    # --- Configuration and Client Setup ---
+    print("Fetching dynamic configuration for parse_receipt...")
+    config = get_cached_config('parse_receipt', timeout=deadline.timeout('config', cap=FIRESTORE_TIMEOUT_CAP_SEC))
+    if not config:
+        raise ValueError("Failed to retrieve dynamic configuration.")
+
+    provider = config.get('provider_name')
+    prompt = config.get('prompt')
+    model_name = config.get('model')
+    # max_tokens = config.get('max_tokens') # Less relevant for Gemini JSON mode, OpenAI uses internally
+
+    print(f"Using Provider: {provider}, Model: {model_name}")
+    if not provider or not model_name or not prompt:
+         raise ValueError(f"Incomplete configuration received: Provider='{provider}', Model='{model_name}', Prompt exists='{prompt is not None}'")
+
+    # Clients are cached per instance; raises for unsupported providers or missing keys
+    adapter = providers.get_adapter('parse_receipt', config, deadline=deadline)
+
+    # --- Image Processing ---
+    temp_image_path = None
+    try:
+        temp_image_path = _download_blob_to_tempfile(bucket_name, blob_name, deadline)
+        mime_type, _ = mimetypes.guess_type(temp_image_path)
+        if not mime_type or not mime_type.startswith("image/"):
+             raise ValueError(f"Downloaded file is not a recognized image type: {mime_type}")
+        print(f"Image downloaded to {temp_image_path}, MIME type: {mime_type}")
+
+        with open(temp_image_path, "rb") as image_file:
+            image_bytes = image_file.read()
+        print(f"Read {len(image_bytes)} bytes from image file.")
+
+        def parse_image(image_bytes, mime_type, note=""):
+            # The configured prompt is the static prefix; only the (optional) band note varies per call
+            return adapter.structured_vision(note, image_bytes, mime_type, ReceiptData, instructions=prompt)
+
+        # --- Provider Call (via adapter) ---
+        # Tall receipts are parsed as overlapping bands in parallel so small lines survive downsampling
+        if tiling.is_tall(image_bytes):
+            try:
+                receipt_data = tiling.parse_tiled(image_bytes, mime_type, parse_image)
+            except Exception:
+                deadline.cancel() # The other bands stop instead of retrying for a result nobody uses
+                raise
+        else:
+            receipt_data = parse_image(image_bytes, mime_type)
+
+        if not receipt_data:
+            raise Exception("Internal error: No receipt data was processed.")
+
+        # --- Arithmetic Reconciliation ---
+        # Fixed locally where one single-line fix balances the receipt; otherwise a short text-only follow-up.
+        # The follow-up is recorded under its own service name in the usage ledger.
+        def ask_corrections(followup_prompt):
+            followup_adapter = providers.get_adapter('reconcile_receipt', config, deadline=deadline)
+            return followup_adapter.structured_text(followup_prompt, ReceiptCorrections,
+                                                    instructions=reconcile.FOLLOWUP_PROMPT)
+
+        receipt_data, _ = reconcile.reconcile(receipt_data, ask=ask_corrections)
+        return receipt_data.model_dump()
+
+    finally:
+        # Clean up temp file
+        if temp_image_path and os.path.exists(temp_image_path):
+            os.remove(temp_image_path)
+            print(f"Cleaned up temporary file: {temp_image_path}")
+
+def _transcribe_blob(bucket_name, blob_name, deadline):
+    """Gets config, downloads the audio and transcribes it with the selected provider. Returns the response data."""
+    # --- Configuration and Client Setup ---
+    print("Fetching dynamic configuration for transcribe_audio...")
+    config = get_cached_config('transcribe_audio', timeout=deadline.timeout('config', cap=FIRESTORE_TIMEOUT_CAP_SEC))
+    if not config:
+        raise ValueError("Failed to retrieve dynamic configuration.")
+
+    provider = config.get('provider_name')
+    model_name = config.get('model')
+    # prompt = config.get('prompt') # Prompt might be used by Gemini for context later
+
+    print(f"Using Provider: {provider}, Model: {model_name}")
+    if not provider or not model_name:
+        raise ValueError(f"Incomplete configuration received: Provider='{provider}', Model='{model_name}'")
+
+    adapter = providers.get_adapter('transcribe_audio', config, deadline=deadline)
+
+    # --- Audio Processing & Transcription ---
+    temp_audio_path = None
     try:
-        # Basic cleanup: remove potential markdown code blocks
-        text = re.sub(r"^```json\n?", "", text.strip(), flags=re.MULTILINE)
-        text = re.sub(r"\n?```$", "", text.strip(), flags=re.MULTILINE)
-        data = json.loads(text)
-        return _validate_data(data, model)
-    except json.JSONDecodeError as e:
-        print(f"Failed to decode JSON: {e}")
-        print(f"Raw text received: {text}")
-        raise ValueError(f"Response was not valid JSON: {e}") from e
-    except Exception as e: # Catch potential validation errors too
-        raise e # Re-raise validation or other errors
+        temp_audio_path = _download_blob_to_tempfile(bucket_name, blob_name, deadline)
+        mime_type, _ = mimetypes.guess_type(temp_audio_path)
+        # Basic audio type check (can be expanded)
+        if not mime_type or not mime_type.startswith("audio/"):
+            # Allow common audio container types even if not strictly audio/
+            if mime_type not in ["application/octet-stream", "video/mp4", "audio/mp4", "audio/mpeg", "audio/wav", "audio/webm", "audio/ogg"]:
+                raise ValueError(f"Downloaded file is not a recognized audio type: {mime_type}")
+        print(f"Audio downloaded to {temp_audio_path}, MIME type: {mime_type}")
+
+        with open(temp_audio_path, "rb") as audio_file:
+            audio_bytes = audio_file.read() # Read once so retries can resend the same upload
+        print(f"Read {len(audio_bytes)} bytes from {temp_audio_path}")
+
+        transcribed_text: str = adapter.transcribe(
+            audio_bytes, mime_type, os.path.basename(temp_audio_path),
+            audio_seconds=_audio_duration_seconds(temp_audio_path)
+        )
+
+        if transcribed_text is None: # Check for None explicitly
+            raise Exception("Internal error: No transcription text was processed.")
+        result = TranscriptionResult(text=transcribed_text)
+        print(f"Transcription result: {result.text[:100]}...")
+        return result.model_dump()
+
+    finally:
+        # Clean up temp file
+        if temp_audio_path and os.path.exists(temp_audio_path):
+            os.remove(temp_audio_path)
+            print(f"Cleaned up temporary file: {temp_audio_path}")
+
+_BLOB_PROCESSORS = {
+    'parse_receipt': _parse_receipt_blob,
+    'transcribe_audio': _transcribe_blob,
+}
+
+def _process_blob_for_request(service_name, bucket_name, blob_name, deadline):
+    """Returns the eager result for a blob if there is one (waiting if it is in progress), else processes it now."""
+    result, claimed = eager.get_or_claim(service_name, bucket_name, blob_name, deadline=deadline)
+    if result is not None:
+        return result
+    try:
+        result = _BLOB_PROCESSORS[service_name](bucket_name, blob_name, deadline)
+    except Exception as e:
+        if claimed:
+            eager.fail(bucket_name, blob_name, e)
+        raise
+    if claimed:
+        eager.complete(bucket_name, blob_name, result)
+    return result
 
 # --- Cloud Functions ---
 
@@ -110,44 +276,14 @@ def _parse_json_from_response(text: str, model: BaseModel):
     timeout_sec=120
 )
 def parse_receipt(req: https_fn.Request) -> https_fn.Response:
-    """Receives GCS URI, gets config, calls selected AI provider (OpenAI/Gemini) for parsing, returns data."""
+    """Receives GCS URI, returns the eagerly parsed result or parses it with the selected AI provider (OpenAI/Gemini)."""
     print("--- PARSE RECEIPT FUNCTION HANDLER ENTERED ---")
-    openai_client = None # Will hold the *patched* client
-    gemini_model = None
+    deadline = Deadline() # Shrinking timeouts for every step, so a stuck call ends in a 504 instead of a kill
 
     try:
-        # --- Configuration and Client Setup ---
-        print("Fetching dynamic configuration for parse_receipt...")
-        config = get_dynamic_config('parse_receipt')
-        if not config:
-            raise ValueError("Failed to retrieve dynamic configuration.")
-
-        provider = config.get('provider_name')
-        prompt = config.get('prompt')
-        model_name = config.get('model')
-        # max_tokens = config.get('max_tokens') # Less relevant for Gemini JSON mode, OpenAI uses internally
-
-        print(f"Using Provider: {provider}, Model: {model_name}")
-        if not provider or not model_name or not prompt:
-             raise ValueError(f"Incomplete configuration received: Provider='{provider}', Model='{model_name}', Prompt exists='{prompt is not None}'")
-
-        if provider == 'openai':
-            openai_api_key = os.environ.get('OPENAI_API_KEY')
-            if not openai_api_key:
-                raise ValueError("OpenAI API key secret ('OPENAI_API_KEY') not found.")
-            # Patch the client with instructor
-            openai_client = instructor.from_openai(OpenAI(api_key=openai_api_key))
-            print("OpenAI client initialized and patched with Instructor.")
-        elif provider == 'gemini':
-            google_api_key = os.environ.get('GOOGLE_API_KEY')
-            if not google_api_key:
-                 raise ValueError("Google API key secret ('GOOGLE_API_KEY') not found.")
-            # Use genai_legacy.Client here
-            client = genai_legacy.Client(api_key=google_api_key)
-            gemini_model_name = model_name # Store the configured model name
-            print(f"Gemini legacy client initialized. Will use model: {gemini_model_name}")
-        else:
-            raise ValueError(f"Unsupported provider selected: {provider}")
+        warmup_result = _warmup_response(req, 'parse_receipt')
+        if warmup_result:
+            return warmup_result
 
         # --- Request Validation ---
         if req.method != "POST":
@@ -162,127 +298,18 @@ def parse_receipt(req: https_fn.Request) -> https_fn.Response:
         if not image_uri:
             raise ValueError("Invalid request: 'data' must contain 'imageUri' field.")
         print(f"Received image URI: {image_uri}")
+        bucket_name, blob_name = _parse_uri(image_uri, 'imageUri')
 
-        match = re.match(r"gs://([^/]+)/(.+)", image_uri)
-        if not match:
-            raise ValueError("Invalid request: 'imageUri' must be a valid gs:// URI.")
-        bucket_name, blob_name = match.groups()
-        print(f"Parsed URI: Bucket='{bucket_name}', Blob='{blob_name}'")
-
-        # --- Image Processing ---
-        temp_image_path = None
-        try:
-            temp_image_path = _download_blob_to_tempfile(bucket_name, blob_name)
-            mime_type, _ = mimetypes.guess_type(temp_image_path)
-            if not mime_type or not mime_type.startswith("image/"):
-                 raise ValueError(f"Downloaded file is not a recognized image type: {mime_type}")
-            print(f"Image downloaded to {temp_image_path}, MIME type: {mime_type}")
-
-            # --- Provider-Specific API Call ---
-            receipt_data: ReceiptData = None
-
-            if provider == 'openai':
-                print("Sending request to OpenAI API via Instructor...")
-                with open(temp_image_path, "rb") as image_file:
-                    base64_image = base64.b64encode(image_file.read()).decode('utf-8')
-
-                # Use instructor's response_model parameter
-                # The response 'receipt_data' should be a validated ReceiptData object
-                receipt_data = openai_client.chat.completions.create(
-                    model=model_name,
-                    response_model=ReceiptData, # Use instructor's response_model
-                    messages=[{
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt},
-                            {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{base64_image}"}}
-                        ]
-                    }],
-                    # max_tokens is usually not needed when using response_model
-                )
-                print("Received and validated response from OpenAI via Instructor.")
-                # No need for _parse_json_from_response here, instructor handles it.
-
-            elif provider == 'gemini':
-                print("Sending request to Gemini API...")
-                # Read image bytes from temporary file
-                with open(temp_image_path, "rb") as image_file:
-                    image_bytes = image_file.read()
-                print(f"Read {len(image_bytes)} bytes from image file.")
-
-                # Ensure prompt is a string
-                if not isinstance(prompt, str):
-                    raise TypeError(f"Prompt must be a string, got: {type(prompt)}")
-
-                # Create image part from bytes using legacy types
-                image_part = genai_legacy_types.Part.from_bytes(
-                    data=image_bytes,
-                    mime_type=mime_type,
-                )
-
-                # Configure generation settings including schema and thinking budget using legacy types
-                generation_config = genai_legacy_types.GenerateContentConfig(
-                    response_mime_type="application/json",
-                    response_schema=ReceiptData, # Specify Pydantic model here
-                    thinking_config=genai_legacy_types.ThinkingConfig(thinking_budget=8000)
-                )
-
-                # Send request using client.models.generate_content
-                response = client.models.generate_content(
-                    model=f'models/{gemini_model_name}', # Use the stored model name
-                    contents=[prompt, image_part], # Send prompt text and image part
-                    config=generation_config # Correct keyword: 'config'
-                )
-
-                print("Received response from Gemini API.")
-
-                # Access the parsed object using response.parsed
-                if hasattr(response, 'parsed') and response.parsed:
-                    # Check if parsed is a list or single object based on schema (ReceiptData)
-                    if isinstance(response.parsed, ReceiptData):
-                        receipt_data = response.parsed # Use directly if it's a single object
-                        print("Successfully retrieved parsed/validated Gemini response.")
-                    # test.py example showed list[ReceiptData], handle that just in case
-                    elif isinstance(response.parsed, list) and len(response.parsed) > 0 and isinstance(response.parsed[0], ReceiptData):
-                         receipt_data = response.parsed[0] # Get the first item if it's a list
-                         print("Successfully retrieved parsed/validated Gemini response (from list).")
-                    else:
-                        # Log the unexpected type/structure
-                        print(f"Warning: Gemini response parsed data is not ReceiptData or list[ReceiptData]. Type: {type(response.parsed)}")
-                        raise ValueError("Gemini response parsed data is not in the expected format (ReceiptData).")
-                else:
-                    # Log the response text if parsing failed or 'parsed' attribute is missing
-                    error_text = response.text if hasattr(response, 'text') else 'No response text available.'
-                    print(f"Warning: Gemini response did not contain expected parsed data. Response text: {error_text}")
-                    # Check for specific safety/block reasons if available
-                    block_reason = None
-                    if response.prompt_feedback and response.prompt_feedback.block_reason:
-                        block_reason = response.prompt_feedback.block_reason.name
-                    elif response.candidates and response.candidates[0].finish_reason:
-                         # finish_reason might indicate blocking or other issues
-                         block_reason = response.candidates[0].finish_reason.name
-
-                    error_message = "Gemini response did not return usable parsed data despite schema request."
-                    if block_reason:
-                         error_message += f" Block/Finish Reason: {block_reason}"
-
-                    raise ValueError(error_message)
-
-            # --- Return Success Response ---
-            if receipt_data:
-                return {"data": receipt_data.model_dump()}
-            else:
-                 raise Exception("Internal error: No receipt data was processed.")
-
-        finally:
-            # Clean up temp file
-            if temp_image_path and os.path.exists(temp_image_path):
-                os.remove(temp_image_path)
-                print(f"Cleaned up temporary file: {temp_image_path}")
+        # --- Return Success Response ---
+        return {"data": _process_blob_for_request('parse_receipt', bucket_name, blob_name, deadline)}
 
     except Exception as e:
         print(f"ERROR processing parse_receipt request: {e}")
         traceback.print_exc()
+        if isinstance(e, rate_limiter.RateLimitExceeded):
+            return _rate_limited_response(e)
+        if isinstance(e, DeadlineExceeded):
+            return _deadline_response(e)
         status_code = 400 if isinstance(e, (ValueError, TypeError)) else 500
         return {"error": {"message": f"{type(e).__name__}: {e}", "status": status_code}}, status_code
 
@@ -296,13 +323,16 @@ def parse_receipt(req: https_fn.Request) -> https_fn.Response:
 def assign_people_to_items(req: https_fn.Request) -> https_fn.Response:
     """Receives transcription and receipt items, calls selected AI for assignment, returns structured result."""
     print("--- ASSIGN PEOPLE FUNCTION HANDLER ENTERED ---")
-    openai_client = None # Patched client
-    gemini_client = None # Patched client for Gemini
+    deadline = Deadline()
 
     try:
+        warmup_result = _warmup_response(req, 'assign_people_to_items')
+        if warmup_result:
+            return warmup_result
+
         # --- Configuration and Client Setup ---
         print("Fetching dynamic configuration for assign_people_to_items...")
-        config = get_dynamic_config('assign_people_to_items')
+        config = get_cached_config('assign_people_to_items', timeout=deadline.timeout('config', cap=FIRESTORE_TIMEOUT_CAP_SEC))
         if not config:
             raise ValueError("Failed to retrieve dynamic configuration.")
 
@@ -314,22 +344,7 @@ def assign_people_to_items(req: https_fn.Request) -> https_fn.Response:
         if not provider or not model_name or not prompt_template:
             raise ValueError(f"Incomplete configuration received: Provider='{provider}', Model='{model_name}', Prompt exists='{prompt_template is not None}'")
 
-        if provider == 'openai':
-            openai_api_key = os.environ.get('OPENAI_API_KEY')
-            if not openai_api_key:
-                raise ValueError("OpenAI API key secret ('OPENAI_API_KEY') not found.")
-            openai_client = instructor.from_openai(OpenAI(api_key=openai_api_key))
-            print("OpenAI client initialized and patched with Instructor.")
-        elif provider == 'gemini':
-            google_api_key = os.environ.get('GOOGLE_API_KEY')
-            if not google_api_key:
-                 raise ValueError("Google API key secret ('GOOGLE_API_KEY') not found.")
-            # Use genai_legacy.Client here
-            client = genai_legacy.Client(api_key=google_api_key)
-            gemini_model_name = model_name # Store the configured model name
-            print(f"Gemini legacy client initialized. Will use model: {gemini_model_name}")
-        else:
-            raise ValueError(f"Unsupported provider selected: {provider}")
+        adapter = providers.get_adapter('assign_people_to_items', config, deadline=deadline)
 
         # --- Request Validation ---
         if req.method != "POST":
@@ -356,91 +371,48 @@ def assign_people_to_items(req: https_fn.Request) -> https_fn.Response:
         print(f"Received Transcription: {transcription[:100]}...")
         print(f"Received Receipt Items: {receipt_items_str[:100]}...")
 
-        # --- Construct the full prompt ---
-        full_prompt = f"{prompt_template}\n\nTranscription:\n{transcription}\n\nReceipt Items JSON:\n{receipt_items_str}"
-
-        # --- Provider-Specific API Call --- 
-        assignment_result: AssignmentResult = None
-
-        if provider == 'openai':
-            print("Sending request to OpenAI API via Instructor...")
-            assignment_result = openai_client.chat.completions.create(
-                model=model_name,
-                response_model=AssignmentResult,
-                messages=[{"role": "user", "content": full_prompt}]
-            )
-            print("Received and validated response from OpenAI via Instructor.")
-
-        elif provider == 'gemini':
-            print("Sending request to Gemini API...")
-
-            # Ensure prompt is a string
-            if not isinstance(full_prompt, str):
-                raise TypeError(f"Prompt must be a string, got: {type(full_prompt)}")
-
-            # Configure generation settings including schema and thinking budget using legacy types
-            generation_config = genai_legacy_types.GenerateContentConfig(
-                response_mime_type="application/json",
-                response_schema=AssignmentResult.model_json_schema(), # Use JSON schema directly instead of model
-                thinking_config=genai_legacy_types.ThinkingConfig(thinking_budget=8000)
-            )
-
-            # Send request using client.models.generate_content
-            response = client.models.generate_content(
-                model=f'models/{gemini_model_name}', # Use the stored model name
-                contents=[full_prompt], # Send the combined prompt
-                config=generation_config # Correct keyword: 'config'
-            )
-
-            print("Received response from Gemini API.")
-
-            # Handle raw JSON response since we're not using schema validation directly
-            if hasattr(response, 'text') and response.text:
-                try:
-                    # Parse the JSON response
-                    json_response = json.loads(response.text)
-                    # Validate with Pydantic model
-                    assignment_result = AssignmentResult.model_validate(json_response)
-                    print("Successfully parsed and validated Gemini JSON response.")
-                except (json.JSONDecodeError, ValidationError) as e:
-                    print(f"Failed to parse/validate Gemini response: {e}")
-                    print(f"Raw response: {response.text}")
-                    raise ValueError(f"Failed to parse Gemini response: {e}")
-            else:
-                error_text = response.text if hasattr(response, 'text') else 'No response text available.'
-                print(f"Warning: Gemini response did not contain expected data. Response text: {error_text}")
-                # Check for specific safety/block reasons if available
-                block_reason = None
-                if hasattr(response, 'prompt_feedback') and response.prompt_feedback and response.prompt_feedback.block_reason:
-                    block_reason = response.prompt_feedback.block_reason.name
-                elif hasattr(response, 'candidates') and response.candidates and response.candidates[0].finish_reason:
-                    block_reason = response.candidates[0].finish_reason.name
-
-                error_message = "Gemini response did not return usable data."
-                if block_reason:
-                    error_message += f" Block/Finish Reason: {block_reason}"
-
-                raise ValueError(error_message)
-
-        # --- Return Success Response --- 
-        if assignment_result:
-            # Convert from new format to old format for backward compatibility
-            result_dict = assignment_result.model_dump()
-            # If using new format, convert to the format expected by frontend
-            if 'person_assignments' in result_dict:
-                assignments_dict = {}
-                for person_assignment in result_dict['person_assignments']:
-                    person_name = person_assignment['person_name']
-                    assignments_dict[person_name] = person_assignment['items']
-                result_dict['assignments'] = assignments_dict
-                del result_dict['person_assignments']
-            return {"data": result_dict}
-        else:
-            raise Exception("Internal error: No assignment result was processed.")
+        # --- Construct the request content ---
+        # The template is sent unchanged as the static instructions, so the provider can serve it from its prompt cache
+        request_content = f"Transcription:\n{transcription}\n\nReceipt Items JSON:\n{receipt_items_str}"
+
+        # --- Incremental mode: re-assign only what the edit touched ---
+        previous_result_json = data.get('previous_result')
+        previous_transcription = data.get('previous_transcription')
+        receipt_items = json.loads(receipt_items_str)
+        if previous_result_json and previous_transcription and isinstance(receipt_items, list):
+            try:
+                previous_result = incremental.result_from_response(previous_result_json)
+            except ValidationError as e:
+                raise ValueError(f"Invalid request: 'previous_result' is not a valid assignment result: {e}")
+            plan = incremental.plan_update(previous_result, previous_transcription, transcription, receipt_items)
+            if plan and plan['unchanged']:
+                print("Incremental assignment: transcription unchanged, returning previous result.")
+                return _assignment_response(previous_result)
+            if plan:
+                print(f"Incremental assignment: re-assigning {len(plan['items'])}/{len(receipt_items)} items, people {plan['people']}.")
+                if plan['items']:
+                    slice_prompt = incremental.build_prompt(plan)
+                    slice_result = adapter.structured_text(slice_prompt, AssignmentResult, instructions=prompt_template)
+                else:
+                    slice_result = AssignmentResult(person_assignments=[], shared_items=[], unassigned_items=[])
+                merged_result = incremental.merge_update(previous_result, plan, slice_result)
+                if merged_result:
+                    return _assignment_response(merged_result)
+                print("Incremental assignment could not be merged, re-assigning everything.")
+
+        # --- Provider Call (via adapter) ---
+        assignment_result = adapter.structured_text(request_content, AssignmentResult, instructions=prompt_template)
+
+        # --- Return Success Response ---
+        return _assignment_response(assignment_result)
 
     except Exception as e:
         print(f"ERROR processing assign_people request: {e}")
         traceback.print_exc()
+        if isinstance(e, rate_limiter.RateLimitExceeded):
+            return _rate_limited_response(e)
+        if isinstance(e, DeadlineExceeded):
+            return _deadline_response(e)
         status_code = 400 if isinstance(e, (ValueError, TypeError, json.JSONDecodeError)) else 500
         return {"error": {"message": f"{type(e).__name__}: {e}", "status": status_code}}, status_code
 
@@ -452,42 +424,14 @@ def assign_people_to_items(req: https_fn.Request) -> https_fn.Response:
     timeout_sec=120
 )
 def transcribe_audio(req: https_fn.Request) -> https_fn.Response:
-    """Receives audio GCS URI, calls selected AI provider (OpenAI/Gemini) for transcription."""
+    """Receives audio GCS URI, returns the eager transcription or transcribes it with the selected AI provider (OpenAI/Gemini)."""
     print("--- TRANSCRIBE AUDIO FUNCTION HANDLER ENTERED ---")
-    openai_client = None
-    gemini_model = None
+    deadline = Deadline()
 
     try:
-        # --- Configuration and Client Setup ---
-        print("Fetching dynamic configuration for transcribe_audio...")
-        config = get_dynamic_config('transcribe_audio')
-        if not config:
-            raise ValueError("Failed to retrieve dynamic configuration.")
-
-        provider = config.get('provider_name')
-        model_name = config.get('model')
-        # prompt = config.get('prompt') # Prompt might be used by Gemini for context later
-
-        print(f"Using Provider: {provider}, Model: {model_name}")
-        if not provider or not model_name:
-            raise ValueError(f"Incomplete configuration received: Provider='{provider}', Model='{model_name}'")
-
-        if provider == 'openai':
-            openai_api_key = os.environ.get('OPENAI_API_KEY')
-            if not openai_api_key:
-                raise ValueError("OpenAI API key secret ('OPENAI_API_KEY') not found.")
-            openai_client = OpenAI(api_key=openai_api_key)
-            print("OpenAI client initialized.")
-        elif provider == 'gemini':
-            google_api_key = os.environ.get('GOOGLE_API_KEY')
-            if not google_api_key:
-                 raise ValueError("Google API key secret ('GOOGLE_API_KEY') not found.")
-            # Use genai_new here
-            genai_new.configure(api_key=google_api_key)
-            gemini_model = genai_new.GenerativeModel(model_name)
-            print(f"Gemini new client initialized for model: {model_name}")
-        else:
-            raise ValueError(f"Unsupported provider selected: {provider}")
+        warmup_result = _warmup_response(req, 'transcribe_audio')
+        if warmup_result:
+            return warmup_result
 
         # --- Request Validation ---
         if req.method != "POST":
@@ -502,80 +446,93 @@ def transcribe_audio(req: https_fn.Request) -> https_fn.Response:
         if not audio_uri:
             raise ValueError("Invalid request: 'data' must contain 'audioUri' field.")
         print(f"Received audio URI: {audio_uri}")
+        bucket_name, blob_name = _parse_uri(audio_uri, 'audioUri')
 
-        match = re.match(r"gs://([^/]+)/(.+)", audio_uri)
-        if not match:
-            raise ValueError("Invalid request: 'audioUri' must be a valid gs:// URI.")
-        bucket_name, blob_name = match.groups()
-        print(f"Parsed URI: Bucket='{bucket_name}', Blob='{blob_name}'")
-
-        # --- Audio Processing & Transcription ---
-        temp_audio_path = None
-        try:
-            temp_audio_path = _download_blob_to_tempfile(bucket_name, blob_name)
-            mime_type, _ = mimetypes.guess_type(temp_audio_path)
-            # Basic audio type check (can be expanded)
-            if not mime_type or not mime_type.startswith("audio/"):
-                # Allow common audio container types even if not strictly audio/
-                if mime_type not in ["application/octet-stream", "video/mp4", "audio/mp4", "audio/mpeg", "audio/wav", "audio/webm", "audio/ogg"]:
-                    raise ValueError(f"Downloaded file is not a recognized audio type: {mime_type}")
-            print(f"Audio downloaded to {temp_audio_path}, MIME type: {mime_type}")
-
-            transcribed_text: str = None
-
-            if provider == 'openai':
-                print("Sending request to OpenAI Whisper API...")
-                with open(temp_audio_path, "rb") as audio_file:
-                    # Use the V1 audio transcriptions endpoint
-                    transcript = openai_client.audio.transcriptions.create(
-                        model=model_name, # Should be 'whisper-1'
-                        file=audio_file
-                    )
-                print("Received response from OpenAI Whisper API.")
-                transcribed_text = transcript.text
-
-            elif provider == 'gemini':
-                print("Sending request to Gemini API for transcription...")
-                # Read audio file bytes
-                with open(temp_audio_path, "rb") as audio_file:
-                    audio_bytes = audio_file.read()
-                print(f"Read {len(audio_bytes)} bytes from {temp_audio_path}")
-
-                # Construct the Part object with inline data
-                audio_part = {"mime_type": mime_type, "data": audio_bytes}
-
-                # Call Gemini model with inline audio data
-                # Optional: Add a simple text prompt if needed/supported for context
-                prompt_for_audio = "Transcribe the following audio:"
-                response = gemini_model.generate_content([prompt_for_audio, audio_part]) # Pass prompt and inline audio part
-                print("Received response from Gemini API.")
-                # No need to delete uploaded file anymore
-
-                transcribed_text = response.text # Assuming response.text contains the transcription
-                if not transcribed_text:
-                     # Check if parts might contain text if response.text is empty
-                    try:
-                        transcribed_text = response.parts[0].text
-                    except (IndexError, AttributeError):
-                         print("Warning: Gemini response text and parts were empty or invalid.")
-                         transcribed_text = "" # Return empty string if no text found
-
-            # --- Format and Return Success Response ---
-            if transcribed_text is not None: # Check for None explicitly
-                 result = TranscriptionResult(text=transcribed_text)
-                 print(f"Transcription result: {result.text[:100]}...")
-                 return {"data": result.model_dump()}
-            else:
-                 raise Exception("Internal error: No transcription text was processed.")
-
-        finally:
-            # Clean up temp file
-            if temp_audio_path and os.path.exists(temp_audio_path):
-                os.remove(temp_audio_path)
-                print(f"Cleaned up temporary file: {temp_audio_path}")
+        # --- Format and Return Success Response ---
+        return {"data": _process_blob_for_request('transcribe_audio', bucket_name, blob_name, deadline)}
 
     except Exception as e:
         print(f"ERROR processing transcribe_audio request: {e}")
         traceback.print_exc()
+        if isinstance(e, rate_limiter.RateLimitExceeded):
+            return _rate_limited_response(e)
+        if isinstance(e, DeadlineExceeded):
+            return _deadline_response(e)
         status_code = 400 if isinstance(e, (ValueError, TypeError)) else 500
-        return {"error": {"message": f"{type(e).__name__}: {e}", "status": status_code}}, status_code
\ No newline at end of file
+        return {"error": {"message": f"{type(e).__name__}: {e}", "status": status_code}}, status_code
+
+# === SETTLE RECEIPTS ===
+@https_fn.on_request(
+    cors=options.CorsOptions(cors_origins="*", cors_methods=["post"]),
+    memory=options.MemoryOption.MB_512, # No provider calls; arithmetic only
+    timeout_sec=60
+)
+def settle_receipts(req: https_fn.Request) -> https_fn.Response:
+    """Receives many receipts with their assignments, returns per-person totals and the transfers that settle them."""
+    print("--- SETTLE RECEIPTS FUNCTION HANDLER ENTERED ---")
+
+    try:
+        # --- Request Validation ---
+        if req.method != "POST":
+            raise ValueError(f"Method {req.method} not allowed.")
+        request_json = req.get_json(silent=True)
+        if not request_json:
+            raise ValueError("Invalid request: No JSON body found.")
+        data = request_json.get('data', {})
+        receipts = data.get('receipts')
+        if not isinstance(receipts, list) or not receipts:
+            raise ValueError("Invalid request: 'data' must contain a non-empty 'receipts' list.")
+
+        started = time.perf_counter()
+        result = settlement.settle(receipts)
+        print(f"Settled {len(receipts)} receipts for {len(result['people'])} people with "
+              f"{len(result['transfers'])} transfers in {(time.perf_counter() - started) * 1000:.1f}ms.")
+
+        # --- Return Success Response ---
+        return {"data": result}
+
+    except Exception as e:
+        print(f"ERROR processing settle_receipts request: {e}")
+        traceback.print_exc()
+        status_code = 400 if isinstance(e, (ValueError, TypeError)) else 500
+        return {"error": {"message": f"{type(e).__name__}: {e}", "status": status_code}}, status_code
+
+# === EAGER PROCESSING OF UPLOADS ===
+@storage_fn.on_object_finalized(
+    secrets=["OPENAI_API_KEY", "GOOGLE_API_KEY"],
+    memory=options.MemoryOption.GB_1,
+    timeout_sec=120
+)
+def process_upload(event: storage_fn.CloudEvent[storage_fn.StorageObjectData]) -> None:
+    """Starts parsing/transcription as soon as a receipt image or audio clip lands in Storage.
+
+    The result is stored in Firestore (see eager.py) for the parse_receipt/transcribe_audio call that follows.
+    """
+    bucket_name = event.data.bucket
+    blob_name = event.data.name
+    service_name = eager.service_for_blob(blob_name or "")
+    if not service_name:
+        return # Not an upload we process eagerly
+
+    print(f"--- PROCESS UPLOAD TRIGGER: {service_name} for gs://{bucket_name}/{blob_name} ---")
+    deadline = Deadline()
+    try:
+        claimed, _ = eager.claim(service_name, bucket_name, blob_name,
+                                 generation=str(event.data.generation), source='trigger',
+                                 timeout=deadline.timeout('eager claim', cap=FIRESTORE_TIMEOUT_CAP_SEC))
+    except Exception as e:
+        print(f"Could not claim {blob_name}, leaving it to the endpoint: {e}")
+        return
+    if not claimed:
+        print(f"{blob_name} is already processed or in progress.")
+        return
+
+    try:
+        result = _BLOB_PROCESSORS[service_name](bucket_name, blob_name, deadline)
+        eager.complete(bucket_name, blob_name, result)
+        print(f"Eager {service_name} stored for {blob_name}.")
+    except Exception as e:
+        # Not re-raised: the endpoint retries a failed result itself, so the trigger is never redelivered
+        print(f"ERROR in eager {service_name} for {blob_name}: {e}")
+        traceback.print_exc()
+        eager.fail(bucket_name, blob_name, e)
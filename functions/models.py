@@ -0,0 +1,42 @@
+from pydantic import BaseModel
+from typing import List
+
+# --- Pydantic Models ---
+# Shared by the Cloud Functions in main.py and the helper modules so schemas
+# can be built once per instance (see warmup.py).
+
+class ReceiptItem(BaseModel):
+    item: str
+    quantity: int
+    price: float
+
+class ReceiptData(BaseModel):
+    items: List[ReceiptItem]
+    subtotal: float
+
+class AssignedItemRef(BaseModel): # Updated Assignment Model for simplicity
+    id: int
+    quantity: int
+
+class PersonAssignment(BaseModel):
+    person_name: str
+    items: List[AssignedItemRef]
+
+class AssignmentResult(BaseModel):
+    person_assignments: List[PersonAssignment] # List of person assignments instead of Dict
+    shared_items: List[AssignedItemRef]
+    unassigned_items: List[AssignedItemRef]
+    # Removed people list - can be derived from assignments keys
+
+class TranscriptionResult(BaseModel):
+    text: str
+
+class LineCorrection(BaseModel): # Answer to a reconciliation follow-up (see reconcile.py)
+    line: int # Line number as listed in the follow-up question
+    action: str # 'keep', 'set_price', 'set_quantity' or 'remove'
+    price: float # Corrected unit price (the current one if unchanged)
+    quantity: int # Corrected quantity (the current one if unchanged)
+
+class ReceiptCorrections(BaseModel):
+    corrections: List[LineCorrection]
+    subtotal: float # Corrected subtotal (the current one if unchanged)
@@ -0,0 +1,202 @@
+"""Gemini explicit context caches for the long static prompt prefixes.
+
+The parse and assign prompts are long instruction blocks that only change with
+the prompt version. For Gemini they are stored once as a cached content
+(`client.caches.create` with the prompt as system instruction) and requests
+reference it by `cached_content` name, so the prefix is neither re-sent nor
+re-billed at the full input rate.
+
+One cache exists per (model, prompt text). Its display name carries the
+service, prompt version and a hash of the prompt, so an instance that has not
+seen it yet finds the cache another instance created instead of making its
+own. Caches are extended in the background shortly before their TTL runs out.
+Gemini only caches prefixes above a model-specific minimum size (see
+MIN_CACHE_TOKENS_BY_MODEL), and Gemini 1.5 only with a versioned model name
+such as 'gemini-1.5-flash-002'. Shorter prompts, or unversioned 1.5 models, are
+sent inline; this is logged once per prompt, since until prompts grow past the
+minimum nothing is cached. Creation failures are remembered for a while and the
+request falls back to an inline system instruction as well.
+"""
+
+import datetime
+import hashlib
+import os
+import re
+import threading
+import time
+from google.genai import types as genai_types
+
+CACHE_TTL_SEC = int(os.environ.get('PROMPT_CACHE_TTL_SEC', '3600'))
+# Extend a cache when less than this is left, so requests never reference an expiring one
+RENEW_BEFORE_SEC = 600
+# Do not retry creating a cache for this long after it failed
+FAILURE_BACKOFF_SEC = 600
+# Minimum prefix size for explicit caching, by model name prefix (first match wins); shorter prompts are
+# sent inline. Prompt size is estimated at about 4 characters per token.
+MIN_CACHE_TOKENS_BY_MODEL = (
+    ('gemini-2.5-flash', 1024),
+    ('gemini-2.5-pro', 4096),
+    ('gemini-2.0', 4096),
+    ('gemini-1.5', 32768),
+)
+# Used for models not listed above
+DEFAULT_MIN_CACHE_TOKENS = 32768
+# Gemini 1.5 caches only work with a pinned model version, e.g. 'gemini-1.5-flash-002'
+_VERSIONED_MODEL = re.compile(r"-\d{3}$")
+CACHE_REQUEST_TIMEOUT_SEC = 10.0
+DISPLAY_NAME_PREFIX = 'prompt'
+
+_lock = threading.Lock()
+_caches = {} # (model, prompt hash) -> (cache name, expire_time)
+_failures = {} # (model, prompt hash) -> monotonic time before which creation is not retried
+_renewing = set()
+_key_locks = {}
+_skipped = set() # (model, prompt hash) already reported as not cacheable
+
+
+def min_cache_tokens(model_name):
+    """Smallest prompt, in tokens, that `model_name` accepts for an explicit context cache."""
+    model_name = (model_name or '').removeprefix('models/')
+    for prefix, tokens in MIN_CACHE_TOKENS_BY_MODEL:
+        if model_name.startswith(prefix):
+            return tokens
+    return DEFAULT_MIN_CACHE_TOKENS
+
+
+def _uncacheable_reason(model_name, instructions):
+    """Why a prompt cannot be cached for a model, or None if it can."""
+    estimated_tokens = len(instructions) // 4
+    minimum = min_cache_tokens(model_name)
+    if estimated_tokens < minimum:
+        return f"prompt is about {estimated_tokens} tokens, below {model_name}'s caching minimum of {minimum}"
+    if model_name.startswith('gemini-1.5') and not _VERSIONED_MODEL.search(model_name):
+        return f"{model_name} needs a versioned model name (e.g. {model_name}-002) for context caching"
+    return None
+
+
+def _prompt_hash(instructions):
+    return hashlib.sha256(instructions.encode('utf-8')).hexdigest()[:16]
+
+
+def _display_name(service_name, prompt_version, prompt_hash):
+    version = f"v{prompt_version}" if prompt_version is not None else 'vnone'
+    return f"{DISPLAY_NAME_PREFIX}-{service_name}-{version}-{prompt_hash}"
+
+
+def _http_options(timeout):
+    return genai_types.HttpOptions(timeout=int(min(timeout or CACHE_REQUEST_TIMEOUT_SEC, CACHE_REQUEST_TIMEOUT_SEC) * 1000))
+
+
+def _seconds_left(expire_time):
+    if expire_time is None:
+        return 0.0
+    return (expire_time - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+
+
+def _find_existing(client, model_name, display_name, timeout):
+    """Returns a live cache another instance created for the same prompt, if any."""
+    for cache in client.caches.list(config=genai_types.ListCachedContentsConfig(http_options=_http_options(timeout))):
+        if (cache.display_name == display_name and (cache.model or '').endswith(model_name)
+                and _seconds_left(cache.expire_time) > RENEW_BEFORE_SEC):
+            return cache
+    return None
+
+
+def _create(client, model_name, instructions, display_name, timeout):
+    return client.caches.create(
+        model=f'models/{model_name}',
+        config=genai_types.CreateCachedContentConfig(
+            display_name=display_name,
+            system_instruction=instructions,
+            ttl=f"{CACHE_TTL_SEC}s",
+            http_options=_http_options(timeout),
+        )
+    )
+
+
+def _renew(client, key, name):
+    """Extends a cache's TTL; on failure the entry is dropped and the next request recreates it."""
+    try:
+        cache = client.caches.update(
+            name=name,
+            config=genai_types.UpdateCachedContentConfig(ttl=f"{CACHE_TTL_SEC}s", http_options=_http_options(None))
+        )
+        with _lock:
+            _caches[key] = (cache.name, cache.expire_time)
+        print(f"Renewed prompt cache {name} until {cache.expire_time}.")
+    except Exception as e:
+        print(f"Warning: could not renew prompt cache {name}: {e}")
+        invalidate(name)
+    finally:
+        with _lock:
+            _renewing.discard(key)
+
+
+def get_cache_name(client, service_name, model_name, instructions, prompt_version=None, timeout=None):
+    """Returns the cached-content name holding `instructions` for `model_name`, creating it if needed.
+
+    Args:
+        client: The google.genai client.
+        service_name (str): Service the prompt belongs to (part of the cache's display name).
+        model_name (str): Gemini model name; caches are model specific.
+        instructions (str): The static prompt prefix.
+        prompt_version (int): Version of the prompt document, if known.
+        timeout (float): Optional upper bound in seconds for a cache API call, e.g. from the request deadline.
+
+    Returns:
+        str or None: The cache name, or None if the prompt should be sent inline.
+    """
+    if not instructions:
+        return None
+    prompt_hash = _prompt_hash(instructions)
+    key = (model_name, prompt_hash)
+    reason = _uncacheable_reason(model_name, instructions)
+    if reason:
+        with _lock:
+            first = key not in _skipped
+            _skipped.add(key)
+        if first:
+            print(f"Prompt cache not used for {service_name}, sending the prompt inline: {reason}.")
+        return None
+
+    with _lock:
+        entry = _caches.get(key)
+        if entry and _seconds_left(entry[1]) > 0:
+            if _seconds_left(entry[1]) < RENEW_BEFORE_SEC and key not in _renewing:
+                _renewing.add(key)
+                threading.Thread(target=_renew, args=(client, key, entry[0]), name='prompt-cache-renew', daemon=True).start()
+            return entry[0]
+        if time.monotonic() < _failures.get(key, 0):
+            return None
+        key_lock = _key_locks.setdefault(key, threading.Lock())
+
+    # One creator per prompt on this instance; concurrent requests wait for it
+    with key_lock:
+        with _lock:
+            entry = _caches.get(key)
+        if entry and _seconds_left(entry[1]) > RENEW_BEFORE_SEC:
+            return entry[0]
+        display_name = _display_name(service_name, prompt_version, prompt_hash)
+        try:
+            cache = _find_existing(client, model_name, display_name, timeout)
+            if cache is None:
+                cache = _create(client, model_name, instructions, display_name, timeout)
+                print(f"Created prompt cache {cache.name} ({display_name}) until {cache.expire_time}.")
+            else:
+                print(f"Using existing prompt cache {cache.name} ({display_name}).")
+        except Exception as e:
+            print(f"Warning: could not create prompt cache for {display_name}, sending the prompt inline: {e}")
+            with _lock:
+                _failures[key] = time.monotonic() + FAILURE_BACKOFF_SEC
+            return None
+        with _lock:
+            _caches[key] = (cache.name, cache.expire_time)
+        return cache.name
+
+
+def invalidate(name):
+    """Forgets a cache, e.g. after a request referencing it failed because it expired or was deleted."""
+    with _lock:
+        for key, entry in list(_caches.items()):
+            if entry[0] == name:
+                del _caches[key]
@@ -0,0 +1,343 @@
+"""Provider adapters: one interface over OpenAI and Gemini.
+
+Handlers call `get_adapter(service_name, config)` and then one of:
+- `structured_vision(prompt, image_bytes, mime_type, response_model, instructions)` - image + prompt -> validated model
+- `structured_text(prompt, response_model, instructions)` - prompt -> validated model
+- `transcribe(audio_bytes, mime_type, filename, audio_seconds)` - audio -> text
+
+`instructions` is the static prompt prefix (the configured prompt template) and
+`prompt` the per-request content. The prefix is always sent first and
+byte-for-byte unchanged so provider prompt caching can apply: as the system
+message for OpenAI (automatic prefix caching), and as an explicit context cache
+referenced by `cached_content` for Gemini (see prompt_cache.py). Both providers
+only cache prefixes above a minimum size (1024 tokens for OpenAI, model
+specific for Gemini); shorter prompts are simply sent in full every time.
+
+Every call goes through the rate limiter and is recorded in the usage ledger,
+so those concerns live here once instead of in every handler branch. Gemini
+uses the single `google.genai` SDK for all three calls. With a request
+deadline, each attempt gets the time left as its SDK timeout.
+"""
+
+import base64
+import copy
+import json
+from abc import ABC, abstractmethod
+import re
+import time
+from pydantic import BaseModel, ValidationError
+from tenacity import Retrying, retry_if_exception_type, stop_after_attempt
+from google.genai import types as genai_types
+from google.genai import errors as genai_errors
+import prompt_cache
+import rate_limiter
+import usage_ledger
+import warmup
+
+DEFAULT_TRANSCRIPTION_PROMPT = "Transcribe the following audio:"
+# Instructor re-asks only when the model's output fails validation; HTTP, rate-limit and connection
+# errors are retried by rate_limiter.limited_call, which honours Retry-After and the token budget
+INSTRUCTOR_VALIDATION_ATTEMPTS = 2
+
+
+def _validation_retrying():
+    """Instructor retry policy: re-ask on invalid output, raise every other error on the first failure."""
+    return Retrying(
+        stop=stop_after_attempt(INSTRUCTOR_VALIDATION_ATTEMPTS),
+        retry=retry_if_exception_type((ValidationError, json.JSONDecodeError)),
+    )
+
+
+def _validate_data(data: dict, model: BaseModel):
+    """Validates dictionary data against a Pydantic model."""
+    try:
+        validated_data = model.model_validate(data)
+        return validated_data
+    except ValidationError as e:
+        print(f"Pydantic validation failed: {e}")
+        print(f"Data being validated: {data}")
+        raise ValueError(f"Output validation failed: {e}") from e
+
+def _parse_json_from_response(text: str, model: BaseModel):
+    """Attempts to parse JSON from text, handling potential markdown/text noise."""
+    try:
+        # Basic cleanup: remove potential markdown code blocks
+        text = re.sub(r"^```json\n?", "", text.strip(), flags=re.MULTILINE)
+        text = re.sub(r"\n?```$", "", text.strip(), flags=re.MULTILINE)
+        data = json.loads(text)
+        return _validate_data(data, model)
+    except json.JSONDecodeError as e:
+        print(f"Failed to decode JSON: {e}")
+        print(f"Raw text received: {text}")
+        raise ValueError(f"Response was not valid JSON: {e}") from e
+    except Exception as e: # Catch potential validation errors too
+        raise e # Re-raise validation or other errors
+
+
+class ProviderAdapter(ABC):
+    """Base adapter. Subclasses implement the three calls for one provider."""
+
+    name = None
+
+    def __init__(self, service_name, model_name, rate_limits=None, prompt_version=None, deadline=None):
+        self.service_name = service_name
+        self.model_name = model_name
+        self.rate_limits = rate_limits
+        self.prompt_version = prompt_version
+        self.deadline = deadline
+
+    def _stage(self, call):
+        return f"{self.name} {call} ({self.service_name})"
+
+    def _timeout(self, call):
+        """Seconds left for one attempt of `call`, or None without a deadline."""
+        if self.deadline is None:
+            return None
+        return self.deadline.timeout(self._stage(call))
+
+    def _call(self, func, usage, estimated_tokens=0, call='request'):
+        """Runs one provider request under the rate limiter and the request deadline.
+
+        Every attempt, including failed and retried ones, is recorded in the usage ledger.
+
+        Args:
+            func (callable): Zero-argument function making the provider call.
+            usage (callable): Maps func's return value to the usage counts to record.
+            estimated_tokens (int): Estimated input + output tokens, for the rate limiter.
+            call (str): Name of the call, for deadline errors.
+        """
+        def attempt():
+            started = time.perf_counter()
+            counts, error = {}, None
+            try:
+                result = func()
+                counts = usage(result)
+                return result
+            except Exception as e:
+                # Failed calls may still be billed, e.g. validation re-asks that never produced a valid answer
+                counts, error = usage_ledger.usage_from_error(e), type(e).__name__
+                raise
+            finally:
+                self._record(started, counts, error=error)
+
+        return rate_limiter.limited_call(self.name, self.model_name, attempt,
+                                         rate_limits=self.rate_limits, estimated_tokens=estimated_tokens,
+                                         deadline=self.deadline, stage=self._stage(call))
+
+    def _record(self, started, usage, error=None):
+        if usage.get('input_tokens'):
+            # Cached tokens confirm the static prefix was served from the provider's prompt cache
+            print(f"Tokens: input {usage['input_tokens']} (cached {usage.get('cached_tokens', 0)}), output {usage.get('output_tokens', 0)}.")
+        usage_ledger.record_usage(self.service_name, self.name, self.model_name, self.prompt_version,
+                                  latency_ms=(time.perf_counter() - started) * 1000, error=error, **usage)
+
+    @abstractmethod
+    def structured_vision(self, prompt, image_bytes, mime_type, response_model, instructions=None):
+        """Sends static instructions, a prompt (may be empty) and an image, returning a validated response_model instance."""
+
+    @abstractmethod
+    def structured_text(self, prompt, response_model, instructions=None):
+        """Sends static instructions and a text prompt, returning a validated response_model instance."""
+
+    @abstractmethod
+    def transcribe(self, audio_bytes, mime_type, filename, audio_seconds=None, prompt=None):
+        """Transcribes audio, returning the text (empty string if nothing was recognised)."""
+
+
+class OpenAIAdapter(ProviderAdapter):
+    """OpenAI chat completions via Instructor for structured output, Whisper for audio."""
+
+    name = 'openai'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.service_name == 'transcribe_audio':
+            self.client = warmup.get_openai_client()
+        else:
+            self.client = warmup.get_openai_client(patched=True) # Instructor-patched for response_model
+
+    def _timeout_kwargs(self, call):
+        # Omitted without a deadline: timeout=None would disable the SDK's default timeout
+        timeout = self._timeout(call)
+        return {} if timeout is None else {"timeout": timeout}
+
+    def _structured(self, content, response_model, estimated_tokens, instructions):
+        # Static instructions first in their own message, so the cacheable prefix never depends on the request
+        messages = [{"role": "system", "content": instructions}] if instructions else []
+        messages.append({"role": "user", "content": content})
+        print("Sending request to OpenAI API via Instructor...")
+        result, completion = self._call(
+            lambda: self.client.chat.completions.create_with_completion( # Keep the raw completion for its usage
+                model=self.model_name,
+                response_model=response_model,
+                messages=messages,
+                max_retries=_validation_retrying(),
+                **self._timeout_kwargs('chat completion')
+            ),
+            lambda response: usage_ledger.usage_from_openai(response[1]), # Instructor sums re-asks into it
+            estimated_tokens=estimated_tokens,
+            call='chat completion'
+        )
+        print("Received and validated response from OpenAI via Instructor.")
+        return result
+
+    def structured_vision(self, prompt, image_bytes, mime_type, response_model, instructions=None):
+        base64_image = base64.b64encode(image_bytes).decode('utf-8')
+        content = [{"type": "text", "text": prompt}] if prompt else []
+        content.append({"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{base64_image}"}})
+        estimated_tokens = rate_limiter.estimate_tokens(f"{instructions or ''}{prompt or ''}", images=1)
+        return self._structured(content, response_model, estimated_tokens, instructions)
+
+    def structured_text(self, prompt, response_model, instructions=None):
+        estimated_tokens = rate_limiter.estimate_tokens(f"{instructions or ''}{prompt}")
+        return self._structured(prompt, response_model, estimated_tokens, instructions)
+
+    def transcribe(self, audio_bytes, mime_type, filename, audio_seconds=None, prompt=None):
+        print("Sending request to OpenAI Whisper API...")
+        transcript = self._call(
+            lambda: self.client.audio.transcriptions.create(
+                model=self.model_name, # Should be 'whisper-1'
+                file=(filename, audio_bytes),
+                response_format="verbose_json", # Includes the billed audio duration
+                **self._timeout_kwargs('transcription')
+            ),
+            lambda transcript: {'audio_seconds': getattr(transcript, 'duration', None) or audio_seconds},
+            call='transcription'
+        )
+        print("Received response from OpenAI Whisper API.")
+        return transcript.text or ""
+
+
+class GeminiAdapter(ProviderAdapter):
+    """Gemini via the google.genai SDK for all three calls."""
+
+    name = 'gemini'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.client = warmup.get_gemini_client()
+
+    @staticmethod
+    def _block_reason(response):
+        """Returns the block/finish reason of an empty response, if any."""
+        if getattr(response, 'prompt_feedback', None) and response.prompt_feedback.block_reason:
+            return response.prompt_feedback.block_reason.name
+        if getattr(response, 'candidates', None) and response.candidates[0].finish_reason:
+            return response.candidates[0].finish_reason.name
+        return None
+
+    def _with_timeout(self, config, call):
+        """Returns a copy of config for one attempt, with the time left as its per-request HTTP timeout."""
+        timeout = self._timeout(call)
+        update = {}
+        if timeout is not None:
+            update["http_options"] = genai_types.HttpOptions(timeout=int(timeout * 1000)) # Milliseconds
+        if config is None:
+            return genai_types.GenerateContentConfig(**update) if update else None
+        if config.response_schema is not None:
+            # The SDK rewrites the schema in place, so every attempt gets its own
+            update["response_schema"] = copy.deepcopy(config.response_schema)
+        return config.model_copy(update=update)
+
+    def _generate(self, contents, config, estimated_tokens, call='generate_content', extra_usage=None):
+        return self._call(
+            lambda: self.client.models.generate_content(
+                model=f'models/{self.model_name}',
+                contents=contents,
+                config=self._with_timeout(config, call)
+            ),
+            lambda response: {**usage_ledger.usage_from_gemini(response), **(extra_usage or {})},
+            estimated_tokens=estimated_tokens,
+            call=call
+        )
+
+    def _prompt_config(self, response_model, instructions):
+        """Returns the generation config carrying the static instructions, and the cache name if one is used."""
+        # Generation settings (schema + thinking budget) are built once per instance
+        config = warmup.get_generation_config(response_model)
+        if not instructions:
+            return config, None
+        cache_timeout = self._timeout('prompt cache') if self.deadline is not None else None
+        cache_name = prompt_cache.get_cache_name(self.client, self.service_name, self.model_name, instructions,
+                                                 self.prompt_version, timeout=cache_timeout)
+        if cache_name:
+            return config.model_copy(update={"cached_content": cache_name}), cache_name
+        return config.model_copy(update={"system_instruction": instructions}), None
+
+    def _structured(self, contents, response_model, estimated_tokens, instructions):
+        config, cache_name = self._prompt_config(response_model, instructions)
+        print(f"Sending request to Gemini API{f' (prompt cache {cache_name})' if cache_name else ''}...")
+        try:
+            response = self._generate(contents, config, estimated_tokens)
+        except genai_errors.ClientError as e:
+            if not cache_name or e.code not in (403, 404):
+                raise
+            # The cache expired or was deleted behind our back: forget it and send the prompt inline once
+            print(f"Prompt cache {cache_name} is unavailable, retrying with the prompt inline: {e}")
+            prompt_cache.invalidate(cache_name)
+            config = warmup.get_generation_config(response_model).model_copy(update={"system_instruction": instructions})
+            response = self._generate(contents, config, estimated_tokens)
+        print("Received response from Gemini API.")
+
+        if not getattr(response, 'text', None):
+            print("Warning: Gemini response did not contain expected data.")
+            error_message = "Gemini response did not return usable data."
+            block_reason = self._block_reason(response)
+            if block_reason:
+                error_message += f" Block/Finish Reason: {block_reason}"
+            raise ValueError(error_message)
+        result = _parse_json_from_response(response.text, response_model)
+        print("Successfully parsed and validated Gemini JSON response.")
+        return result
+
+    def structured_vision(self, prompt, image_bytes, mime_type, response_model, instructions=None):
+        # Ensure prompt is a string
+        if not isinstance(prompt, str):
+            raise TypeError(f"Prompt must be a string, got: {type(prompt)}")
+        image_part = genai_types.Part.from_bytes(data=image_bytes, mime_type=mime_type)
+        contents = [prompt, image_part] if prompt else [image_part]
+        estimated_tokens = rate_limiter.estimate_tokens(f"{instructions or ''}{prompt}", images=1)
+        return self._structured(contents, response_model, estimated_tokens, instructions)
+
+    def structured_text(self, prompt, response_model, instructions=None):
+        if not isinstance(prompt, str):
+            raise TypeError(f"Prompt must be a string, got: {type(prompt)}")
+        estimated_tokens = rate_limiter.estimate_tokens(f"{instructions or ''}{prompt}")
+        return self._structured([prompt], response_model, estimated_tokens, instructions)
+
+    def transcribe(self, audio_bytes, mime_type, filename, audio_seconds=None, prompt=None):
+        print("Sending request to Gemini API for transcription...")
+        prompt = prompt or DEFAULT_TRANSCRIPTION_PROMPT
+        audio_part = genai_types.Part.from_bytes(data=audio_bytes, mime_type=mime_type)
+        response = self._generate(
+            [prompt, audio_part], None,
+            rate_limiter.estimate_tokens(prompt, audio_seconds=audio_seconds or len(audio_bytes) / 32000),
+            call='transcription', extra_usage={'audio_seconds': audio_seconds}
+        )
+        print("Received response from Gemini API.")
+        if not response.text:
+            print("Warning: Gemini response text was empty.")
+        return response.text or ""
+
+
+_ADAPTERS = {adapter.name: adapter for adapter in (OpenAIAdapter, GeminiAdapter)}
+
+
+def get_adapter(service_name, config, deadline=None):
+    """Builds the adapter for the provider selected in a service's dynamic config.
+
+    Args:
+        service_name (str): Service name, used for the usage ledger.
+        config (dict): The service's dynamic config (see config_helper.get_cached_config).
+        deadline (Deadline): Optional request deadline applied to every call.
+
+    Raises:
+        ValueError: If the provider is unsupported or its API key is missing.
+    """
+    provider = config.get('provider_name')
+    adapter_class = _ADAPTERS.get(provider)
+    if adapter_class is None:
+        raise ValueError(f"Unsupported provider selected: {provider}")
+    return adapter_class(service_name, config.get('model'),
+                         rate_limits=config.get('rate_limits'), prompt_version=config.get('prompt_version'),
+                         deadline=deadline)
@@ -0,0 +1,344 @@
+"""Per-provider/model rate limiting and retry scheduling for LLM calls.
+
+Every provider call goes through `limited_call()`, which:
+1. Waits in a small FIFO queue until the (provider, model) token bucket has room for
+   one request and its estimated tokens, or rejects the call once `max_queue_wait_sec`
+   passes or the queue is full.
+2. Retries rate-limit and transient errors with jittered exponential backoff, using the
+   provider's Retry-After / x-ratelimit-reset-* headers when present, and pauses the
+   bucket so concurrent requests on the same instance back off too.
+
+With a request deadline (deadline.py), queueing and backoff never wait past it:
+a call that cannot be admitted or retried in the time left raises DeadlineExceeded.
+
+Budgets come from the `rate_limits` map of each provider entry in the
+`configs/models/{service}/current` documents (see init_firestore_config.py).
+Buckets live in instance memory, so they are shared by the concurrent requests
+an instance serves; the configured budgets are per instance.
+
+Per (provider, model) counters (calls, queue wait, throttle events, retries,
+rejections) are logged at most every STATS_LOG_INTERVAL_SEC as one JSON line
+each with "metric": "rate_limiter", covering the calls since the previous line,
+so Cloud Logging can turn them into log-based metrics.
+"""
+
+import atexit
+import email.utils
+import json
+import random
+import re
+import threading
+import time
+from collections import deque
+import httpx
+import openai
+from deadline import DeadlineExceeded, MIN_STAGE_SEC
+
+# Used when the model document has no 'rate_limits' entry. None means unlimited.
+DEFAULT_RATE_LIMITS = {
+    "requests_per_minute": None,
+    "tokens_per_minute": None,
+    "max_queue_wait_sec": 20,
+    "max_queue_size": 16,
+    "max_retries": 3,
+}
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+BACKOFF_BASE_SEC = 1.0
+BACKOFF_CAP_SEC = 20.0
+STATS_LOG_INTERVAL_SEC = 60.0
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a call cannot be admitted or keeps being rate limited within its time budget."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ("tokens",)
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+
+class ProviderLimiter:
+    """Token buckets for requests and tokens per minute, with a FIFO wait queue."""
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, max_queue_size=16):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_queue_size = max_queue_size
+        self._request_level = float(requests_per_minute or 0)
+        self._token_level = float(tokens_per_minute or 0)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._queue = deque()
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        if self.requests_per_minute:
+            self._request_level = min(self.requests_per_minute, self._request_level + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self._token_level = min(self.tokens_per_minute, self._token_level + elapsed * self.tokens_per_minute / 60)
+
+    def _delay_for(self, tokens, now):
+        """Seconds until one request of `tokens` tokens fits in both buckets."""
+        delay = max(self._paused_until - now, 0.0)
+        if self.requests_per_minute and self._request_level < 1:
+            delay = max(delay, (1 - self._request_level) * 60 / self.requests_per_minute)
+        if self.tokens_per_minute:
+            tokens = min(tokens, self.tokens_per_minute) # A single oversized call must still be admissible
+            if self._token_level < tokens:
+                delay = max(delay, (tokens - self._token_level) * 60 / self.tokens_per_minute)
+        return delay
+
+    def acquire(self, tokens, max_wait):
+        """Blocks until the call may proceed and returns the seconds spent waiting.
+
+        Raises:
+            RateLimitExceeded: If the queue is full or the call would wait longer than max_wait.
+        """
+        started = time.monotonic()
+        deadline = started + max_wait
+        waiter = _Waiter(tokens)
+        with self._cond:
+            if len(self._queue) >= self.max_queue_size:
+                raise RateLimitExceeded(f"Rate limiter queue is full ({self.max_queue_size} waiting).", retry_after=1)
+            self._queue.append(waiter)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    is_head = self._queue[0] is waiter
+                    delay = self._delay_for(tokens, now) if is_head else max_wait
+                    if is_head and delay <= 0:
+                        if self.requests_per_minute:
+                            self._request_level -= 1
+                        if self.tokens_per_minute:
+                            self._token_level -= min(tokens, self.tokens_per_minute)
+                        return now - started
+                    remaining = deadline - now
+                    if remaining <= 0 or (is_head and delay > remaining):
+                        raise RateLimitExceeded(
+                            f"Rate limit budget would be exceeded; needed to wait {delay:.1f}s, allowed {max(remaining, 0):.1f}s.",
+                            retry_after=delay
+                        )
+                    self._cond.wait(min(delay, remaining))
+            finally:
+                self._queue.remove(waiter)
+                self._cond.notify_all()
+
+    def pause(self, seconds):
+        """Stops admitting calls for `seconds`, e.g. after the provider answered 429."""
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._request_level = min(self._request_level, 0.0)
+            self._cond.notify_all()
+
+
+_limiters = {} # (provider, model) -> (limits tuple, ProviderLimiter)
+_limiters_lock = threading.Lock()
+_stats = {} # (provider, model) -> counters since the last stats log line
+_stats_lock = threading.Lock()
+_stats_logged_at = time.monotonic()
+
+
+def resolve_limits(rate_limits):
+    """Merges a 'rate_limits' config map over DEFAULT_RATE_LIMITS."""
+    limits = dict(DEFAULT_RATE_LIMITS)
+    limits.update({key: value for key, value in (rate_limits or {}).items() if key in DEFAULT_RATE_LIMITS})
+    return limits
+
+
+def get_limiter(provider, model, rate_limits=None):
+    """Returns the shared limiter for (provider, model), rebuilding it if its budgets changed."""
+    limits = resolve_limits(rate_limits)
+    key = (limits["requests_per_minute"], limits["tokens_per_minute"], limits["max_queue_size"])
+    with _limiters_lock:
+        entry = _limiters.get((provider, model))
+        if entry is None or entry[0] != key:
+            entry = (key, ProviderLimiter(*key))
+            _limiters[(provider, model)] = entry
+        return entry[1]
+
+
+def estimate_tokens(text="", images=0, audio_seconds=0, output_tokens=1000):
+    """Rough token estimate used for the tokens-per-minute bucket (about 4 characters per token)."""
+    return int(len(text or "") / 4 + images * 1100 + audio_seconds * 32 + output_tokens)
+
+
+def _record(provider, model, **counts):
+    with _stats_lock:
+        stats = _stats.setdefault((provider, model), {
+            "calls": 0, "queue_wait_sec": 0.0, "throttle_events": 0, "retries": 0, "rejected": 0
+        })
+        for name, value in counts.items():
+            stats[name] += value
+
+
+def log_stats(force=False):
+    """Logs and resets the limiter counters once STATS_LOG_INTERVAL_SEC has passed since the last log (or if force)."""
+    global _stats_logged_at
+    now = time.monotonic()
+    with _stats_lock:
+        if not _stats or (not force and now - _stats_logged_at < STATS_LOG_INTERVAL_SEC):
+            return
+        stats, interval = dict(_stats), now - _stats_logged_at
+        _stats.clear()
+        _stats_logged_at = now
+    for (provider, model), counters in stats.items():
+        print(json.dumps({
+            "metric": "rate_limiter", "provider": provider, "model": model,
+            "interval_sec": round(interval, 1), **counters,
+            "queue_wait_sec": round(counters["queue_wait_sec"], 3),
+        }))
+
+
+atexit.register(log_stats, force=True)
+
+
+def _parse_duration(value):
+    """Parses '20ms', '1s', '6m0s' or a plain number of seconds."""
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def retry_after_from_headers(headers):
+    """Returns the server-suggested delay in seconds from rate-limit headers, or None."""
+    if not headers:
+        return None
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        seconds = _parse_duration(retry_after)
+        if seconds is None:
+            try:
+                seconds = email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                seconds = None
+        if seconds is not None:
+            return max(seconds, 0.0)
+    resets = [_parse_duration(headers[name]) for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens") if headers.get(name)]
+    resets = [seconds for seconds in resets if seconds is not None]
+    return max(resets) if resets else None
+
+
+def _classify(exc):
+    """Returns (status_code, headers) for a retryable provider error, or None if it should not be retried.
+
+    Walks the exception cause chain, since Instructor wraps the underlying OpenAI errors.
+    """
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        if isinstance(exc, openai.APIConnectionError): # Includes APITimeoutError
+            return 503, None
+        status = getattr(exc, "status_code", None) or getattr(exc, "code", None)
+        if isinstance(status, int) and status in RETRYABLE_STATUS_CODES:
+            response = getattr(exc, "response", None)
+            return status, getattr(response, "headers", None)
+        exc = exc.__cause__ or exc.__context__
+    return None
+
+
+def _is_timeout(exc):
+    """True if the exception (or one it wraps) is an SDK request timeout."""
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        if isinstance(exc, (openai.APITimeoutError, httpx.TimeoutException)):
+            return True
+        exc = exc.__cause__ or exc.__context__
+    return False
+
+
+def limited_call(provider, model, func, rate_limits=None, estimated_tokens=0, deadline=None, stage=None):
+    """Runs func() under the (provider, model) limiter, retrying rate-limit and transient errors.
+
+    Args:
+        provider (str): Provider name ('openai', 'gemini').
+        model (str): Model name; each model has its own budget.
+        func (callable): Zero-argument function making the provider call.
+        rate_limits (dict): The provider's 'rate_limits' config map (optional).
+        estimated_tokens (int): Estimated input + output tokens for the call.
+        deadline (Deadline): Optional request deadline bounding queueing, retries and backoff.
+        stage (str): Name of the call reported in DeadlineExceeded. Defaults to '<provider> call'.
+
+    Returns:
+        The return value of func().
+
+    Raises:
+        RateLimitExceeded: If the call could not be admitted, or was still rate limited after max_retries.
+        DeadlineExceeded: If the deadline ran out while queueing, calling or backing off.
+    """
+    stage = stage or f"{provider} call"
+    limits = resolve_limits(rate_limits)
+    limiter = get_limiter(provider, model, rate_limits)
+    queue_wait = 0.0
+    throttles = 0
+    attempt = 0
+    try:
+        while True:
+            max_wait = limits["max_queue_wait_sec"]
+            if deadline is not None:
+                max_wait = min(max_wait, deadline.timeout(f"{stage} (rate limit queue)"))
+            try:
+                queue_wait += limiter.acquire(estimated_tokens, max_wait)
+            except RateLimitExceeded as e:
+                _record(provider, model, rejected=1)
+                if deadline is not None and e.retry_after is not None and e.retry_after > deadline.remaining():
+                    raise DeadlineExceeded(f"{stage} (rate limit queue)") from e
+                raise
+            try:
+                return func()
+            except Exception as e:
+                if deadline is not None and (deadline.remaining() < MIN_STAGE_SEC or _is_timeout(e)):
+                    # The SDK timeout is the time that was left, so a timeout means the deadline was reached
+                    raise DeadlineExceeded(stage) from e
+                classified = _classify(e)
+                if classified is None:
+                    raise
+                status, headers = classified
+                server_delay = retry_after_from_headers(headers)
+                if status == 429:
+                    throttles += 1
+                    limiter.pause(server_delay if server_delay is not None else BACKOFF_BASE_SEC)
+                if attempt >= limits["max_retries"]:
+                    if status == 429:
+                        raise RateLimitExceeded(f"{provider}/{model} is still rate limited after {attempt} retries.", retry_after=server_delay) from e
+                    raise
+                if server_delay is not None:
+                    delay = server_delay + random.uniform(0, 0.25 * max(server_delay, BACKOFF_BASE_SEC))
+                else:
+                    delay = random.uniform(0, min(BACKOFF_CAP_SEC, BACKOFF_BASE_SEC * 2 ** attempt)) # Full jitter
+                if deadline is not None and delay > deadline.remaining() - MIN_STAGE_SEC:
+                    raise DeadlineExceeded(f"{stage} (retry backoff)") from e
+                attempt += 1
+                _record(provider, model, retries=1)
+                print(f"Provider {provider}/{model} returned {status}; retry {attempt}/{limits['max_retries']} in {delay:.2f}s.")
+                time.sleep(delay)
+    finally:
+        _record(provider, model, calls=1, queue_wait_sec=queue_wait, throttle_events=throttles)
+        log_stats()
+        if queue_wait >= 0.05 or throttles:
+            print(f"Rate limiter {provider}/{model}: queued {queue_wait:.2f}s, {throttles} throttle event(s), {attempt} retry(ies).")
@@ -0,0 +1,205 @@
+"""Local arithmetic reconciliation of parsed receipts.
+
+The parse prompt asks for unit prices with add-ons rolled into their parent
+item, and the two mistakes models make most often break the arithmetic in a
+recognisable way: a line price reported as the unit price of a multi-quantity
+line, or an add-on counted both in its parent and as its own line. When the
+items do not add up to the subtotal, this module tries every single-line fix
+of those kinds and applies it if exactly one balances the receipt. Only when
+none (or more than one) does, the suspect lines are sent back to the model as
+a short text-only question - the image is not re-sent.
+
+Each outcome is logged as one JSON line with "metric": "receipt_reconciliation",
+which Cloud Logging turns into structured fields for a log-based metric.
+"""
+
+import json
+import re
+from models import ReceiptItem, ReceiptData
+
+SUBTOTAL_TOLERANCE = 0.02
+# Unit prices are rounded to cents, so each unit of a multi-quantity line may be off by half a cent
+ROUNDING_PER_UNIT = 0.005
+# At most this many lines are put in a follow-up question
+MAX_SUSPECT_LINES = 12
+
+_ADD_ON = re.compile(r"^\s*(\+|add\b|extra\b|xtra\b|side\b|sub\b|w/|with\b|no\b|upgrade\b)", re.IGNORECASE)
+_NON_ALNUM = re.compile(r"[^a-z0-9]+")
+
+FOLLOWUP_PROMPT = """The receipt below was transcribed from a photo, but its items do not add up to its subtotal.
+Rules used for the transcription:
+- 'price' is the price of ONE unit. If the receipt shows quantity 2 for $10.00, the price is 5.00.
+- Add-ons and modifiers without their own price line are rolled into the parent item's price. An add-on must not be counted both in its parent and as its own line.
+- A line with its own price is a separate item.
+
+Review only the suspect lines and return one correction per suspect line:
+- action 'keep' if the line is correct,
+- 'set_price' with the corrected unit price,
+- 'set_quantity' with the corrected quantity,
+- 'remove' if the line is counted twice.
+Always fill 'price' and 'quantity' (repeat the current values when unchanged). Return the subtotal, corrected only if it is clearly the wrong number.
+"""
+
+
+def items_total(items):
+    return round(sum(item.price * item.quantity for item in items), 2)
+
+
+def _tolerance(items):
+    return SUBTOTAL_TOLERANCE + ROUNDING_PER_UNIT * sum(item.quantity for item in items if item.quantity > 1)
+
+
+def discrepancy(receipt):
+    """Items total minus subtotal, rounded to cents."""
+    return round(items_total(receipt.items) - receipt.subtotal, 2)
+
+
+def is_balanced(receipt):
+    """True if the items add up to the subtotal within rounding."""
+    return abs(discrepancy(receipt)) <= _tolerance(receipt.items)
+
+
+def _normalize(name):
+    return _NON_ALNUM.sub(" ", name.lower()).strip()
+
+
+def _is_add_on(item):
+    return bool(_ADD_ON.match(item.item))
+
+
+def _has_duplicate(items, index):
+    item = items[index]
+    return any(
+        other_index != index and _normalize(other.item) == _normalize(item.item) and abs(other.price - item.price) < 0.005
+        for other_index, other in enumerate(items)
+    )
+
+
+def candidate_fixes(receipt):
+    """Returns the distinct single-line fixes that make the items add up to the subtotal.
+
+    Returns:
+        list: Dicts with 'line' (0-based index), 'action' ('set_price' or 'remove'), 'reason' and 'items'
+        (the corrected item list).
+    """
+    items = list(receipt.items)
+    fixes = []
+    seen = set()
+    for index, item in enumerate(items):
+        options = []
+        if item.quantity > 1:
+            options.append(('set_price', round(item.price / item.quantity, 2), "line price reported as unit price"))
+            options.append(('set_price', round(item.price * item.quantity, 2), "unit price divided by quantity twice"))
+        if _is_add_on(item) or _has_duplicate(items, index):
+            options.append(('remove', None, "add-on or duplicate line counted twice"))
+
+        for action, price, reason in options:
+            replacement = [] if action == 'remove' else [ReceiptItem(item=item.item, quantity=item.quantity, price=price)]
+            new_items = items[:index] + replacement + items[index + 1:]
+            if abs(items_total(new_items) - receipt.subtotal) > _tolerance(new_items):
+                continue
+            # Removing either of two identical lines is the same fix
+            key = tuple((new_item.item, new_item.quantity, new_item.price) for new_item in new_items)
+            if key in seen:
+                continue
+            seen.add(key)
+            fixes.append({"line": index, "action": action, "reason": reason, "items": new_items})
+    return fixes
+
+
+def suspect_lines(receipt):
+    """Indexes of the lines most likely to be wrong: multi-quantity, add-on and duplicate lines first,
+    then lines whose total is closest to the discrepancy."""
+    items = receipt.items
+    gap = abs(discrepancy(receipt))
+    def rank(index):
+        item = items[index]
+        flagged = item.quantity > 1 or _is_add_on(item) or _has_duplicate(items, index)
+        return (not flagged, abs(item.price * item.quantity - gap))
+    return sorted(sorted(range(len(items)), key=rank)[:MAX_SUSPECT_LINES])
+
+
+def followup_prompt(receipt, suspects):
+    """Builds the text-only follow-up question about the suspect lines.
+
+    FOLLOWUP_PROMPT is not included; it is sent as the static instructions in front of this text.
+    """
+    def line(index):
+        item = receipt.items[index]
+        return {"line": index + 1, "item": item.item, "quantity": item.quantity, "price": item.price}
+    others = [line(index) for index in range(len(receipt.items)) if index not in suspects]
+    return (
+        f"Subtotal on the receipt: {receipt.subtotal:.2f}\n"
+        f"Sum of quantity x price: {items_total(receipt.items):.2f}\n\n"
+        f"Suspect lines:\n{json.dumps([line(index) for index in suspects])}\n\n"
+        f"Other lines (context only, do not correct):\n{json.dumps(others)}"
+    )
+
+
+def apply_corrections(receipt, suspects, corrections):
+    """Applies a follow-up answer to the suspect lines. Corrections for other lines are ignored."""
+    allowed = {index + 1 for index in suspects}
+    by_line = {correction.line: correction for correction in corrections.corrections if correction.line in allowed}
+    items = []
+    for index, item in enumerate(receipt.items):
+        correction = by_line.get(index + 1)
+        if correction is None or correction.action == 'keep':
+            items.append(item)
+        elif correction.action == 'set_price':
+            items.append(ReceiptItem(item=item.item, quantity=item.quantity, price=correction.price))
+        elif correction.action == 'set_quantity':
+            items.append(ReceiptItem(item=item.item, quantity=correction.quantity, price=item.price))
+        elif correction.action != 'remove':
+            print(f"Ignoring unknown correction action '{correction.action}' for line {index + 1}.")
+            items.append(item)
+    subtotal = corrections.subtotal if corrections.subtotal and corrections.subtotal > 0 else receipt.subtotal
+    return ReceiptData(items=items, subtotal=subtotal)
+
+
+def reconcile(receipt, ask=None):
+    """Checks a parsed receipt's arithmetic and repairs it locally, or with one follow-up question.
+
+    Args:
+        receipt (ReceiptData): The validated parse result.
+        ask (callable): Optional ask(prompt) -> ReceiptCorrections, used when no unique local fix exists.
+            The prompt is followup_prompt(); FOLLOWUP_PROMPT should be sent as its instructions.
+
+    Returns:
+        tuple: (ReceiptData, report dict). The receipt is returned unchanged if it could not be balanced.
+    """
+    report = {
+        "status": "balanced",
+        "discrepancy": discrepancy(receipt),
+        "items": len(receipt.items),
+        "fix": None,
+        "followup": False,
+    }
+    result = receipt
+    if receipt.subtotal <= 0:
+        report["status"] = "no_subtotal" # Nothing to check against
+    elif not is_balanced(receipt):
+        fixes = candidate_fixes(receipt)
+        if len(fixes) == 1:
+            fix = fixes[0]
+            result = ReceiptData(items=fix["items"], subtotal=receipt.subtotal)
+            report.update(status="fixed_locally", fix=f"{fix['action']} line {fix['line'] + 1}: {fix['reason']}")
+        elif ask is None:
+            report["status"] = "unresolved"
+        else:
+            # Several fixes balance it: ask about just those lines. None does: ask about the likeliest culprits
+            suspects = sorted({fix["line"] for fix in fixes}) if fixes else suspect_lines(receipt)
+            report.update(followup=True, suspect_lines=len(suspects), candidate_fixes=len(fixes))
+            try:
+                corrected = apply_corrections(receipt, suspects, ask(followup_prompt(receipt, suspects)))
+            except Exception as e:
+                print(f"Reconciliation follow-up failed, keeping the parsed receipt: {e}")
+                corrected = None
+            if corrected is not None and is_balanced(corrected):
+                result = corrected
+                report["status"] = "fixed_by_followup"
+            else:
+                report["status"] = "unresolved"
+    report["discrepancy_after"] = discrepancy(result)
+
+    print(json.dumps({"metric": "receipt_reconciliation", **report}))
+    return result, report
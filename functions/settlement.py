@@ -0,0 +1,262 @@
+"""Settlement across many receipts: who owes whom for a whole trip.
+
+Each receipt carries its parsed items, the assignment output returned by
+`assign_people_to_items` ('assignments', 'shared_items', 'unassigned_items'),
+its tax and tip percentages and the person who paid it. The split follows the
+app's final summary screen:
+
+- assigned items are charged to their person,
+- shared items are split equally among everyone on the receipt,
+- tax and tip are percentages applied to each person's subtotal,
+- whatever is left unassigned stays with the payer and is reported separately.
+
+Receipts are flattened into NumPy arrays (one entry per assigned or shared
+line) so the totals for all receipts and people are a few vectorised
+operations. Balances are settled in whole cents with the greedy
+largest-debtor/largest-creditor matching, which needs at most one transfer
+fewer than the number of people with a non-zero balance.
+"""
+
+import heapq
+import numpy as np
+
+
+def _percent(receipt, key, index):
+    value = receipt.get(key, 0) or 0
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Receipt {index}: '{key}' must be a number (percentage).")
+    if value < 0:
+        raise ValueError(f"Receipt {index}: '{key}' must not be negative.")
+    return value
+
+
+def _refs(refs, receipt_index, field_name):
+    """Returns (id, quantity) pairs of an assignment list; quantities must be positive integers."""
+    if not isinstance(refs, list):
+        raise ValueError(f"Receipt {receipt_index}: '{field_name}' must be a list.")
+    pairs = []
+    for ref in refs:
+        if not isinstance(ref, dict) or 'id' not in ref or 'quantity' not in ref:
+            raise ValueError(f"Receipt {receipt_index}: entries in '{field_name}' need 'id' and 'quantity'.")
+        try:
+            quantity = int(ref['quantity'])
+        except (TypeError, ValueError):
+            quantity = 0
+        if quantity <= 0 or quantity != ref['quantity']:
+            raise ValueError(f"Receipt {receipt_index}: quantity of item {ref['id']} in '{field_name}' must be a positive integer.")
+        pairs.append((ref['id'], quantity))
+    return pairs
+
+
+def build_arrays(receipts):
+    """Flattens receipts into the arrays used by settle().
+
+    Item ids are 1-based positions in each receipt's 'items' list, unless items carry their own 'id'.
+
+    Raises:
+        ValueError: On malformed receipts, duplicate or unknown item ids, or non-positive assigned quantities.
+    """
+    people = {} # name -> index
+    def person(name):
+        if not isinstance(name, str) or not name.strip():
+            raise ValueError("Person names must be non-empty strings.")
+        return people.setdefault(name.strip(), len(people))
+
+    prices, quantities, item_receipts = [], [], []
+    charge_item, charge_person, charge_quantity = [], [], []
+    shared_item, shared_quantity = [], []
+    members_receipt, members_person = [], []
+    payers, multipliers = [], []
+
+    for receipt_index, receipt in enumerate(receipts):
+        if not isinstance(receipt, dict):
+            raise ValueError(f"Receipt {receipt_index}: must be an object.")
+        items = receipt.get('items')
+        if not isinstance(items, list) or not items:
+            raise ValueError(f"Receipt {receipt_index}: 'items' must be a non-empty list.")
+        payer = receipt.get('paid_by')
+        if not payer:
+            raise ValueError(f"Receipt {receipt_index}: 'paid_by' is required.")
+        payers.append(person(payer))
+        multipliers.append(1 + (_percent(receipt, 'tax', receipt_index) + _percent(receipt, 'tip', receipt_index)) / 100)
+
+        offset = len(prices)
+        item_index = {}
+        for position, item in enumerate(items):
+            try:
+                item_id = int(item.get('id', position + 1))
+                prices.append(float(item['price']))
+                quantities.append(int(item['quantity']))
+            except (AttributeError, KeyError, TypeError, ValueError):
+                raise ValueError(f"Receipt {receipt_index}: item {position + 1} needs a numeric 'price' and 'quantity'.")
+            if item_id in item_index:
+                raise ValueError(f"Receipt {receipt_index}: duplicate item id {item_id}.")
+            item_index[item_id] = offset + position
+            item_receipts.append(receipt_index)
+
+        def global_item(item_id):
+            try:
+                return item_index[int(item_id)]
+            except (KeyError, TypeError, ValueError):
+                raise ValueError(f"Receipt {receipt_index}: unknown item id {item_id}.")
+
+        assignments = receipt.get('assignments') or {}
+        if not isinstance(assignments, dict):
+            raise ValueError(f"Receipt {receipt_index}: 'assignments' must map person names to item lists.")
+        members = {person(name) for name in receipt.get('people') or []}
+        for name, refs in assignments.items():
+            person_index = person(name)
+            members.add(person_index)
+            for item_id, quantity in _refs(refs, receipt_index, 'assignments'):
+                charge_item.append(global_item(item_id))
+                charge_person.append(person_index)
+                charge_quantity.append(quantity)
+        for item_id, quantity in _refs(receipt.get('shared_items') or [], receipt_index, 'shared_items'):
+            shared_item.append(global_item(item_id))
+            shared_quantity.append(quantity)
+        for person_index in sorted(members):
+            members_receipt.append(receipt_index)
+            members_person.append(person_index)
+        # 'unassigned_items' is not needed: anything not assigned or shared is unassigned
+
+    return {
+        "names": list(people),
+        "price": np.asarray(prices, dtype=np.float64),
+        "quantity": np.asarray(quantities, dtype=np.int64),
+        "item_receipt": np.asarray(item_receipts, dtype=np.int64),
+        "charge_item": np.asarray(charge_item, dtype=np.int64),
+        "charge_person": np.asarray(charge_person, dtype=np.int64),
+        "charge_quantity": np.asarray(charge_quantity, dtype=np.int64),
+        "shared_item": np.asarray(shared_item, dtype=np.int64),
+        "shared_quantity": np.asarray(shared_quantity, dtype=np.int64),
+        "members_receipt": np.asarray(members_receipt, dtype=np.int64),
+        "members_person": np.asarray(members_person, dtype=np.int64),
+        "payer": np.asarray(payers, dtype=np.int64),
+        "multiplier": np.asarray(multipliers, dtype=np.float64),
+    }
+
+
+def _to_cents(amounts):
+    """Rounds amounts to whole cents, keeping their rounded sum (largest-remainder method)."""
+    scaled = amounts * 100
+    cents = np.floor(scaled).astype(np.int64)
+    shortfall = int(round(float(scaled.sum()))) - int(cents.sum())
+    if shortfall > 0:
+        cents[np.argsort(cents - scaled)[:shortfall]] += 1
+    elif shortfall < 0:
+        cents[np.argsort(scaled - cents)[:-shortfall]] -= 1
+    return cents
+
+
+def minimal_transfers(names, balance_cents):
+    """Greedy settlement: repeatedly pays the largest creditor from the largest debtor.
+
+    Args:
+        names (list): Person names.
+        balance_cents (array): Per-person balance in cents (positive = is owed money); must sum to zero.
+
+    Returns:
+        list: {'from', 'to', 'amount'} transfers.
+    """
+    creditors = [(-int(cents), index) for index, cents in enumerate(balance_cents) if cents > 0]
+    debtors = [(int(cents), index) for index, cents in enumerate(balance_cents) if cents < 0]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+    transfers = []
+    while creditors and debtors:
+        credit, creditor = heapq.heappop(creditors)
+        debt, debtor = heapq.heappop(debtors)
+        amount = min(-credit, -debt)
+        transfers.append({"from": names[debtor], "to": names[creditor], "amount": amount / 100})
+        if -credit > amount:
+            heapq.heappush(creditors, (credit + amount, creditor))
+        if -debt > amount:
+            heapq.heappush(debtors, (debt + amount, debtor))
+    return transfers
+
+
+def settle(receipts):
+    """Computes per-person totals over all receipts and the transfers that settle them.
+
+    Args:
+        receipts (list): Receipt dicts with 'items' (item, quantity, price), 'assignments', 'shared_items',
+            'unassigned_items', 'tax' and 'tip' (percentages), 'paid_by' and optionally 'people' (everyone
+            sharing the receipt's shared items; defaults to the people in 'assignments').
+
+    Returns:
+        dict: 'people' (name, consumed, paid, balance), 'transfers', 'receipts' (total, unassigned) and
+        'unassigned_total'.
+
+    Raises:
+        ValueError: On malformed input or over-assigned items.
+    """
+    arrays = build_arrays(receipts)
+    names = arrays["names"]
+    people_count = len(names)
+    receipt_count = len(receipts)
+    price, multiplier = arrays["price"], arrays["multiplier"]
+    item_receipt = arrays["item_receipt"]
+
+    # Quantities handed out per item may not exceed what is on the receipt
+    handed_out = np.bincount(arrays["charge_item"], weights=arrays["charge_quantity"], minlength=len(price))
+    handed_out += np.bincount(arrays["shared_item"], weights=arrays["shared_quantity"], minlength=len(price))
+    over = np.flatnonzero(handed_out > arrays["quantity"])
+    if over.size:
+        first = over[0]
+        receipt_index = int(item_receipt[first])
+        raise ValueError(
+            f"Receipt {receipt_index}: line {first - np.searchsorted(item_receipt, receipt_index) + 1} is handed out "
+            f"{int(handed_out[first])} times but has quantity {int(arrays['quantity'][first])} ({over.size} over-assigned item(s))."
+        )
+
+    # Assigned lines, with tax and tip of their receipt
+    charge_receipt = item_receipt[arrays["charge_item"]]
+    charge_amount = price[arrays["charge_item"]] * arrays["charge_quantity"] * multiplier[charge_receipt]
+    consumed = np.bincount(arrays["charge_person"], weights=charge_amount, minlength=people_count)
+
+    # Shared lines, split equally among the receipt's members
+    shared_receipt = item_receipt[arrays["shared_item"]]
+    shared_total = np.bincount(
+        shared_receipt, weights=price[arrays["shared_item"]] * arrays["shared_quantity"], minlength=receipt_count
+    ) * multiplier
+    member_count = np.bincount(arrays["members_receipt"], minlength=receipt_count)
+    per_member = np.divide(shared_total, member_count, out=np.zeros(receipt_count), where=member_count > 0)
+    consumed += np.bincount(arrays["members_person"], weights=per_member[arrays["members_receipt"]], minlength=people_count)
+
+    # Each payer is owed what everybody consumed on their receipts; shared items without members and
+    # unassigned quantities stay with the payer
+    charged = np.bincount(charge_receipt, weights=charge_amount, minlength=receipt_count)
+    charged += np.where(member_count > 0, shared_total, 0.0)
+    paid = np.bincount(arrays["payer"], weights=charged, minlength=people_count)
+    receipt_total = np.bincount(item_receipt, weights=price * arrays["quantity"], minlength=receipt_count) * multiplier
+    unassigned = receipt_total - charged
+
+    consumed_cents = _to_cents(consumed)
+    paid_cents = _to_cents(paid)
+    # Rounding both sides separately may leave a cent over; it goes to whoever paid the most
+    paid_cents[int(np.argmax(paid_cents))] += int(consumed_cents.sum() - paid_cents.sum())
+    balance_cents = paid_cents - consumed_cents
+
+    return {
+        "people": [
+            {
+                "name": name,
+                "consumed": int(consumed_cents[index]) / 100,
+                "paid": int(paid_cents[index]) / 100,
+                "balance": int(balance_cents[index]) / 100,
+            }
+            for index, name in enumerate(names)
+        ],
+        "transfers": minimal_transfers(names, balance_cents),
+        "receipts": [
+            {
+                "id": receipt.get('id', index),
+                "total": round(float(receipt_total[index]), 2),
+                "unassigned": round(float(unassigned[index]), 2),
+            }
+            for index, receipt in enumerate(receipts)
+        ],
+        "unassigned_total": round(float(unassigned.sum()), 2),
+    }
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Cloud Functions modules are flat files in functions/, imported by name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
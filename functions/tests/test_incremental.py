@@ -0,0 +1,116 @@
+import pytest
+
+import incremental
+from models import AssignmentResult
+
+ITEMS = [
+    {"id": 1, "item": "Burger", "quantity": 1, "price": 10.0},
+    {"id": 2, "item": "Salad", "quantity": 1, "price": 8.0},
+    {"id": 3, "item": "Coke", "quantity": 1, "price": 2.0},
+    {"id": 4, "item": "Fries", "quantity": 1, "price": 4.0},
+    {"id": 5, "item": "Pasta", "quantity": 1, "price": 12.0},
+    {"id": 6, "item": "Wine", "quantity": 1, "price": 9.0},
+]
+TRANSCRIPTION = (
+    "Jon had the burger. Amy had the salad. Bob had pasta and wine. Jon also had a coke. Amy also had fries."
+)
+
+
+def _previous():
+    return incremental.result_from_response({
+        "assignments": {
+            "Jon": [{"id": 1, "quantity": 1}, {"id": 3, "quantity": 1}],
+            "Amy": [{"id": 2, "quantity": 1}, {"id": 4, "quantity": 1}],
+            "Bob": [{"id": 5, "quantity": 1}, {"id": 6, "quantity": 1}],
+        },
+        "shared_items": [],
+        "unassigned_items": [],
+    })
+
+
+def _held(result):
+    return {
+        assignment.person_name: sorted(ref.id for ref in assignment.items)
+        for assignment in result.person_assignments
+    }
+
+
+def _slice(assignments, unassigned=()):
+    return AssignmentResult.model_validate({
+        "person_assignments": [{"person_name": name, "items": items} for name, items in assignments.items()],
+        "shared_items": [],
+        "unassigned_items": list(unassigned),
+    })
+
+
+def test_name_correction_reopens_only_the_edited_sentence_items():
+    edited = TRANSCRIPTION.replace("Jon had the burger", "John had the burger")
+    plan = incremental.plan_update(_previous(), TRANSCRIPTION, edited, ITEMS)
+
+    assert [item["id"] for item in plan["items"]] == [1]
+    assert plan["people"] == ["Jon"]
+    assert plan["changed_text"] == "John had the burger."
+    # The unchanged sentence giving Jon the coke is sent as context
+    assert "Jon also had a coke." in plan["context_text"]
+
+    merged = incremental.merge_update(_previous(), plan, _slice({"John": [{"id": 1, "quantity": 1}]}))
+    assert _held(merged) == {"Jon": [3], "Amy": [2, 4], "Bob": [5, 6], "John": [1]}
+    assert merged.unassigned_items == []
+
+
+def test_deleted_sentence_keeps_items_from_unchanged_sentences():
+    edited = TRANSCRIPTION.replace(" Amy also had fries.", "")
+    plan = incremental.plan_update(_previous(), TRANSCRIPTION, edited, ITEMS)
+
+    assert [item["id"] for item in plan["items"]] == [4]
+    assert plan["removed_text"] == "Amy also had fries."
+    assert "Amy had the salad." in plan["context_text"]
+
+    merged = incremental.merge_update(_previous(), plan, _slice({}))
+    assert _held(merged) == {"Jon": [1, 3], "Amy": [2], "Bob": [5, 6]}
+    assert [(ref.id, ref.quantity) for ref in merged.unassigned_items] == [(4, 1)]
+
+
+def test_added_pronoun_sentence_sends_the_preceding_sentence():
+    previous = incremental.result_from_response({
+        "assignments": {"Jon": [{"id": 1, "quantity": 1}, {"id": 3, "quantity": 1}],
+                        "Amy": [{"id": 2, "quantity": 1}], "Bob": [{"id": 5, "quantity": 1}, {"id": 6, "quantity": 1}]},
+        "unassigned_items": [{"id": 4, "quantity": 1}],
+    })
+    before = "Jon had the burger. Amy had the salad. Bob had pasta and wine. Jon also had a coke."
+    after = "Jon had the burger. Amy had the salad. She also had the fries. Bob had pasta and wine. Jon also had a coke."
+    plan = incremental.plan_update(previous, before, after, ITEMS)
+
+    assert [item["id"] for item in plan["items"]] == [4]
+    assert "Amy had the salad." in plan["context_text"]
+    merged = incremental.merge_update(previous, plan, _slice({"Amy": [{"id": 4, "quantity": 1}]}))
+    assert _held(merged)["Amy"] == [2, 4]
+    assert merged.unassigned_items == []
+
+
+def test_unchanged_transcription_is_reported():
+    assert incremental.plan_update(_previous(), TRANSCRIPTION, TRANSCRIPTION, ITEMS) == {"unchanged": True}
+
+
+def test_receipt_edited_since_previous_result_falls_back():
+    items = ITEMS + [{"id": 7, "item": "Cake", "quantity": 1, "price": 6.0}]
+    edited = TRANSCRIPTION.replace("Jon had the burger", "John had the burger")
+    assert incremental.plan_update(_previous(), TRANSCRIPTION, edited, items) is None
+
+
+def test_items_without_ids_fall_back():
+    items = [{key: value for key, value in item.items() if key != "id"} for item in ITEMS]
+    assert incremental.plan_update(_previous(), TRANSCRIPTION, TRANSCRIPTION + " Bob had a coke.", items) is None
+
+
+def test_merge_rejects_over_assigned_slice():
+    edited = TRANSCRIPTION.replace("Jon had the burger", "John had the burger")
+    plan = incremental.plan_update(_previous(), TRANSCRIPTION, edited, ITEMS)
+    slice_result = _slice({"John": [{"id": 1, "quantity": 1}], "Amy": [{"id": 1, "quantity": 1}]})
+    assert incremental.merge_update(_previous(), plan, slice_result) is None
+
+
+@pytest.mark.parametrize("previous_result", ["not a dict", [1], {"assignments": ["Jon"]}])
+def test_malformed_previous_result_is_rejected(previous_result):
+    with pytest.raises(ValueError):
+        incremental.result_from_response(previous_result)
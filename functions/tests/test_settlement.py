@@ -0,0 +1,102 @@
+import random
+
+import pytest
+
+import settlement
+
+
+def _receipt(**overrides):
+    receipt = {
+        "items": [
+            {"item": "Pizza", "quantity": 2, "price": 10.0},
+            {"item": "Salad", "quantity": 1, "price": 7.5},
+        ],
+        "assignments": {"A": [{"id": 1, "quantity": 1}], "B": [{"id": 1, "quantity": 1}]},
+        "shared_items": [{"id": 2, "quantity": 1}],
+        "unassigned_items": [],
+        "tax": 10,
+        "tip": 0,
+        "paid_by": "A",
+    }
+    receipt.update(overrides)
+    return receipt
+
+
+def test_splits_assigned_and_shared_items():
+    result = settlement.settle([_receipt()])
+    people = {person["name"]: person for person in result["people"]}
+    assert people["A"]["consumed"] == pytest.approx(15.13, abs=0.01)
+    assert people["B"]["consumed"] == pytest.approx(15.12, abs=0.01)
+    assert result["transfers"] == [{"from": "B", "to": "A", "amount": people["B"]["consumed"]}]
+    assert result["unassigned_total"] == 0
+
+
+@pytest.mark.parametrize("quantity", [-1, 0, 1.5, None])
+def test_rejects_non_positive_or_fractional_assignment_quantity(quantity):
+    receipt = _receipt(assignments={"A": [{"id": 1, "quantity": 3}], "B": [{"id": 1, "quantity": quantity}]})
+    with pytest.raises(ValueError, match="positive integer"):
+        settlement.settle([receipt])
+
+
+def test_rejects_non_positive_shared_quantity():
+    with pytest.raises(ValueError, match="positive integer"):
+        settlement.settle([_receipt(shared_items=[{"id": 2, "quantity": -1}])])
+
+
+def test_rejects_duplicate_item_ids():
+    items = [
+        {"id": 1, "item": "Pizza", "quantity": 2, "price": 10.0},
+        {"id": 1, "item": "Salad", "quantity": 1, "price": 7.5},
+    ]
+    with pytest.raises(ValueError, match="duplicate item id 1"):
+        settlement.settle([_receipt(items=items, shared_items=[])])
+
+
+def test_rejects_over_assigned_items():
+    receipt = _receipt(assignments={"A": [{"id": 1, "quantity": 2}], "B": [{"id": 1, "quantity": 1}]})
+    with pytest.raises(ValueError, match="handed out 3 times but has quantity 2"):
+        settlement.settle([receipt])
+
+
+def test_to_cents_keeps_the_rounded_sum():
+    rng = random.Random(7)
+    for _ in range(200):
+        amounts = settlement.np.array([rng.uniform(0, 50) / 3 for _ in range(rng.randint(1, 20))])
+        cents = settlement._to_cents(amounts)
+        assert int(cents.sum()) == round(float(amounts.sum() * 100))
+        assert settlement.np.all(settlement.np.abs(cents - amounts * 100) < 1)
+
+
+def test_balances_and_transfers_settle_to_the_cent():
+    rng = random.Random(11)
+    names = [f"P{index}" for index in range(7)]
+    receipts = []
+    for _ in range(15):
+        items = [{"item": f"I{index}", "quantity": 3, "price": round(rng.uniform(1, 30), 2)} for index in range(6)]
+        assignments = {}
+        for item_id in range(1, 5):
+            for _ in range(3):
+                assignments.setdefault(rng.choice(names), []).append({"id": item_id, "quantity": 1})
+        receipts.append({
+            "items": items,
+            "assignments": assignments,
+            "shared_items": [{"id": 5, "quantity": 3}],
+            "unassigned_items": [{"id": 6, "quantity": 3}],
+            "people": names,
+            "tax": 8.875,
+            "tip": 18,
+            "paid_by": rng.choice(names),
+        })
+    result = settlement.settle(receipts)
+    consumed = sum(round(person["consumed"] * 100) for person in result["people"])
+    paid = sum(round(person["paid"] * 100) for person in result["people"])
+    assert consumed == paid
+    assert sum(round(person["balance"] * 100) for person in result["people"]) == 0
+
+    # Applying the transfers leaves every balance at zero
+    balances = {person["name"]: round(person["balance"] * 100) for person in result["people"]}
+    for transfer in result["transfers"]:
+        balances[transfer["from"]] += round(transfer["amount"] * 100)
+        balances[transfer["to"]] -= round(transfer["amount"] * 100)
+    assert set(balances.values()) == {0}
+    assert len(result["transfers"]) < len(names)
@@ -0,0 +1,219 @@
+"""Tiled parsing of long receipts.
+
+A tall receipt photographed in one shot gets downsampled so heavily by the
+vision models that small line items are lost. Tall images are split into
+overlapping horizontal bands that are parsed in parallel; the per-band item
+lists are merged in order, items read twice in an overlap are dropped, and
+the subtotal is taken from the last band that shows one. When dropping the
+longest repeated runs leaves the total off the subtotal, shorter runs are
+tried, since identical neighbouring lines may be separate items.
+"""
+
+import difflib
+import io
+import itertools
+import math
+import re
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from PIL import Image, ImageOps
+from models import ReceiptData
+
+# Images taller than this (height / width) are parsed in bands
+TALL_ASPECT_RATIO = 2.5
+# Height of each band relative to the image width
+BAND_ASPECT_RATIO = 1.5
+# Fraction of each band repeated at the top of the next one, so no line is cut in half everywhere
+BAND_OVERLAP = 0.15
+MAX_BANDS = 8
+# Totals within this amount are considered reconciled
+SUBTOTAL_TOLERANCE = 0.02
+# Overlap combinations tried when the longest overlaps do not reconcile with the subtotal
+MAX_OVERLAP_COMBINATIONS = 4096
+
+_NON_ALNUM = re.compile(r"[^a-z0-9]+")
+
+
+def _open_image(image_bytes):
+    image = Image.open(io.BytesIO(image_bytes))
+    return ImageOps.exif_transpose(image) # Phone photos often rely on EXIF rotation
+
+
+def is_tall(image_bytes):
+    """Returns True if the image is tall enough to be parsed in bands."""
+    try:
+        width, height = _open_image(image_bytes).size
+    except Exception as e:
+        print(f"Could not read image dimensions, parsing as a single image: {e}")
+        return False
+    return width > 0 and height / width > TALL_ASPECT_RATIO
+
+
+def split_into_bands(image_bytes, mime_type):
+    """Splits a tall image into overlapping horizontal bands.
+
+    Returns:
+        list: (band_bytes, band_mime_type) tuples, top to bottom.
+    """
+    image = _open_image(image_bytes)
+    width, height = image.size
+    band_height = int(width * BAND_ASPECT_RATIO)
+    overlap = int(band_height * BAND_OVERLAP)
+    count = min(MAX_BANDS, max(1, math.ceil((height - overlap) / (band_height - overlap))))
+    if count == MAX_BANDS:
+        # Stretch the bands instead of dropping the bottom of the receipt
+        band_height = math.ceil((height + overlap * (count - 1)) / count)
+    step = band_height - overlap
+
+    # Keep PNG lossless; everything else is re-encoded as JPEG
+    band_format, band_mime_type = ("PNG", "image/png") if mime_type == "image/png" else ("JPEG", "image/jpeg")
+    if band_format == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    bands = []
+    for index in range(count):
+        top = min(index * step, max(height - band_height, 0))
+        band = image.crop((0, top, width, min(top + band_height, height)))
+        buffer = io.BytesIO()
+        band.save(buffer, format=band_format, quality=90)
+        bands.append((buffer.getvalue(), band_mime_type))
+    return bands
+
+
+def band_note(index, count):
+    """Band context sent with each band, after the unchanged parse prompt."""
+    return (
+        f"**Note:** This image is part {index + 1} of {count} of one long receipt, cut into horizontal strips that "
+        "overlap slightly. Extract every item visible in this part, including items cut off at the top or bottom "
+        "edge if their name and price are readable. If the subtotal is not visible in this part, return 0 for subtotal."
+    )
+
+
+def _normalize(name):
+    return _NON_ALNUM.sub(" ", name.lower()).strip()
+
+
+def _same_item(a, b):
+    if a.quantity != b.quantity or abs(a.price - b.price) > SUBTOTAL_TOLERANCE:
+        return False
+    name_a, name_b = _normalize(a.item), _normalize(b.item)
+    return name_a == name_b or difflib.SequenceMatcher(a=name_a, b=name_b).ratio() >= 0.85
+
+
+def _max_overlap(previous, current):
+    """Most items the overlap between two bands can hold.
+
+    The overlap is BAND_OVERLAP of a band's height, so it holds about that share of a band's items, plus one
+    line cut at the edge.
+    """
+    return min(len(previous), len(current), math.ceil(BAND_OVERLAP * max(len(previous), len(current))) + 1)
+
+
+def _overlap_lengths(previous, current):
+    """Lengths (longest first, always ending with 0) of the runs ending `previous` that also start `current`."""
+    lengths = [
+        length for length in range(_max_overlap(previous, current), 0, -1)
+        if all(_same_item(a, b) for a, b in zip(previous[-length:], current[:length]))
+    ]
+    return lengths + [0]
+
+
+def _choose_overlaps(bands, subtotal):
+    """Picks one overlap length per band boundary.
+
+    Prefers the longest matching runs. When they leave the merged total off the subtotal, shorter runs
+    (down to 0, i.e. identical neighbouring items that are really separate lines) are tried, keeping the
+    combination that reconciles and removes the most items.
+
+    Returns:
+        list: Overlap length for each band after the first.
+    """
+    candidates = [_overlap_lengths(previous, current) for previous, current in zip(bands, bands[1:])]
+    longest = [lengths[0] for lengths in candidates]
+    if subtotal is None:
+        return longest
+
+    def removed_total(band, length):
+        return sum(item.price * item.quantity for item in band[:length])
+
+    all_total = sum(item.price * item.quantity for band in bands for item in band)
+    best = None
+    for lengths in itertools.islice(itertools.product(*candidates), MAX_OVERLAP_COMBINATIONS):
+        removed = sum(removed_total(band, length) for band, length in zip(bands[1:], lengths))
+        if abs(all_total - removed - subtotal) <= SUBTOTAL_TOLERANCE and (best is None or sum(lengths) > sum(best)):
+            best = list(lengths)
+    if best is None:
+        return longest
+    if best != longest:
+        print(f"Longest band overlaps {longest} miss the subtotal; using overlaps {best}, which reconcile.")
+    return best
+
+
+def merge_bands(band_results):
+    """Merges per-band ReceiptData (top to bottom) into one ReceiptData.
+
+    Returns:
+        tuple: (ReceiptData, report dict with 'bands', 'duplicates_removed', 'items_total', 'subtotal', 'discrepancy').
+    """
+    bands = [list(result.items) for result in band_results]
+    # The subtotal is printed near the bottom, so prefer the last band that reports one
+    subtotal = next((result.subtotal for result in reversed(band_results) if result.subtotal), None)
+
+    overlaps = _choose_overlaps(bands, subtotal)
+    items = list(bands[0]) if bands else []
+    for band, skip in zip(bands[1:], overlaps):
+        items.extend(band[skip:])
+    duplicates = sum(overlaps)
+
+    items_total = round(sum(item.price * item.quantity for item in items), 2)
+    if subtotal is None:
+        print("No band reported a subtotal; using the sum of the merged items.")
+        subtotal = items_total
+    discrepancy = round(items_total - subtotal, 2)
+    if abs(discrepancy) > SUBTOTAL_TOLERANCE:
+        print(f"Tiled parse does not reconcile: items total {items_total} vs subtotal {subtotal} (difference {discrepancy}).")
+
+    report = {
+        "bands": len(band_results),
+        "duplicates_removed": duplicates,
+        "overlaps": overlaps,
+        "items_total": items_total,
+        "subtotal": subtotal,
+        "discrepancy": discrepancy,
+    }
+    return ReceiptData(items=items, subtotal=subtotal), report
+
+
+def parse_tiled(image_bytes, mime_type, parse_band):
+    """Parses a tall receipt in parallel bands.
+
+    Args:
+        image_bytes (bytes): The full receipt image.
+        mime_type (str): MIME type of image_bytes.
+        parse_band (callable): parse_band(band_bytes, band_mime_type, band_note) -> ReceiptData. The note goes
+            after the configured parse prompt, which stays unchanged so it can be served from the prompt cache.
+
+    Returns:
+        ReceiptData: The merged receipt.
+
+    Raises:
+        Exception: The first band failure. Bands still running are not waited for; the caller should
+        cancel their deadline so they stop retrying.
+    """
+    bands = split_into_bands(image_bytes, mime_type)
+    print(f"Parsing tall receipt in {len(bands)} overlapping bands.")
+    executor = ThreadPoolExecutor(max_workers=len(bands))
+    futures = [
+        executor.submit(parse_band, band_bytes, band_mime_type, band_note(index, len(bands)))
+        for index, (band_bytes, band_mime_type) in enumerate(bands)
+    ]
+    # Fail as soon as any band fails instead of waiting for the slowest one
+    wait(futures, return_when=FIRST_EXCEPTION)
+    failed = next((future for future in futures if future.done() and future.exception()), None)
+    if failed is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise failed.exception()
+    executor.shutdown()
+    band_results = [future.result() for future in futures]
+    receipt_data, report = merge_bands(band_results)
+    print(f"Tiled parse merged: {report}")
+    return receipt_data
@@ -0,0 +1,187 @@
+"""Token usage and cost ledger for provider calls.
+
+Every provider call attempt records one usage entry (tokens, audio seconds,
+latency, and the error type if it failed) tagged with service, provider, model
+and prompt version, so failed and retried calls are counted too. Entries are buffered
+in memory and written to Firestore by a background thread in batched writes:
+one document per call in `usage_ledger`, plus daily rollups in `usage_rollups`
+keyed by date/service/provider/model/prompt version and updated with
+Increment transforms. `record_usage()` only appends to the buffer, so a
+handler's response never waits on Firestore.
+
+Cloud Functions may throttle CPU between requests, so buffered entries are
+flushed on the next request's activity or when the instance shuts down.
+"""
+
+import atexit
+import datetime
+import re
+import threading
+from collections import deque
+from firebase_admin import firestore
+
+LEDGER_COLLECTION = 'usage_ledger'
+ROLLUP_COLLECTION = 'usage_rollups'
+FLUSH_INTERVAL_SEC = 5.0
+# Each entry costs one write plus its share of rollup writes; stays well under the 500-write batch limit
+FLUSH_BATCH_SIZE = 200
+MAX_BUFFERED = 5000 # Oldest entries are dropped beyond this if Firestore is unreachable
+
+COUNTER_FIELDS = ('input_tokens', 'output_tokens', 'thinking_tokens', 'cached_tokens', 'audio_seconds', 'latency_ms')
+
+_buffer = deque(maxlen=MAX_BUFFERED)
+_lock = threading.Lock()
+_wake = threading.Event()
+_flusher = None
+_UNSAFE_ID_CHARS = re.compile(r"[^A-Za-z0-9_.-]+")
+
+
+def usage_from_openai(completion):
+    """Extracts token counts from an OpenAI chat completion's `usage`."""
+    usage = getattr(completion, 'usage', None)
+    if usage is None:
+        return {}
+    completion_details = getattr(usage, 'completion_tokens_details', None)
+    prompt_details = getattr(usage, 'prompt_tokens_details', None)
+    return {
+        'input_tokens': usage.prompt_tokens or 0,
+        'output_tokens': usage.completion_tokens or 0,
+        'thinking_tokens': getattr(completion_details, 'reasoning_tokens', None) or 0,
+        'cached_tokens': getattr(prompt_details, 'cached_tokens', None) or 0,
+    }
+
+
+def usage_from_gemini(response):
+    """Extracts token counts from a Gemini response's `usage_metadata`."""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return {}
+    return {
+        'input_tokens': getattr(usage, 'prompt_token_count', None) or 0,
+        'output_tokens': getattr(usage, 'candidates_token_count', None) or 0,
+        'thinking_tokens': getattr(usage, 'thoughts_token_count', None) or 0,
+        'cached_tokens': getattr(usage, 'cached_content_token_count', None) or 0,
+    }
+
+
+def usage_from_error(error):
+    """Extracts whatever usage a failed call reports, e.g. the summed usage of Instructor's failed re-asks."""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        total_usage = getattr(error, 'total_usage', None)
+        if total_usage is not None:
+            return usage_from_openai(type('Completion', (), {'usage': total_usage})())
+        error = error.__cause__ or error.__context__
+    return {}
+
+
+def record_usage(service, provider, model, prompt_version=None, latency_ms=0.0, error=None, **counts):
+    """Buffers one usage entry. Never blocks on Firestore and never raises.
+
+    Args:
+        service (str): Service name, e.g. 'parse_receipt'.
+        provider (str): 'openai' or 'gemini'.
+        model (str): Model name.
+        prompt_version (int): Version of the prompt document used, if known.
+        latency_ms (float): Wall-clock duration of the provider call.
+        error (str): Exception type name if the call failed, else None.
+        **counts: Any of input_tokens, output_tokens, thinking_tokens, cached_tokens, audio_seconds.
+    """
+    try:
+        entry = {
+            'service': service,
+            'provider': provider,
+            'model': model,
+            'prompt_version': prompt_version,
+            'latency_ms': round(latency_ms, 1),
+            'error': error,
+            'timestamp': datetime.datetime.now(datetime.timezone.utc),
+        }
+        for field in COUNTER_FIELDS:
+            if field != 'latency_ms':
+                entry[field] = counts.get(field) or 0
+        with _lock:
+            _buffer.append(entry)
+            pending = len(_buffer)
+        _ensure_flusher()
+        if pending >= FLUSH_BATCH_SIZE:
+            _wake.set()
+    except Exception as e:
+        print(f"Warning: could not record usage: {e}")
+
+
+def _rollup_id(entry):
+    key = "_".join(str(part) for part in (
+        entry['timestamp'].strftime('%Y-%m-%d'), entry['service'], entry['provider'], entry['model'],
+        f"v{entry['prompt_version']}" if entry['prompt_version'] is not None else 'vnone'
+    ))
+    return _UNSAFE_ID_CHARS.sub('-', key)
+
+
+def _write(entries):
+    """Writes entries and their aggregated rollup increments in one batch."""
+    db = firestore.client()
+    batch = db.batch()
+    rollups = {}
+    for entry in entries:
+        batch.set(db.collection(LEDGER_COLLECTION).document(), entry)
+        rollup = rollups.setdefault(_rollup_id(entry), {
+            'date': entry['timestamp'].strftime('%Y-%m-%d'),
+            'service': entry['service'],
+            'provider': entry['provider'],
+            'model': entry['model'],
+            'prompt_version': entry['prompt_version'],
+            'calls': 0,
+            'errors': 0,
+            **{field: 0 for field in COUNTER_FIELDS},
+        })
+        rollup['calls'] += 1
+        rollup['errors'] += 1 if entry.get('error') else 0
+        for field in COUNTER_FIELDS:
+            rollup[field] += entry[field]
+    for rollup_id, rollup in rollups.items():
+        update = {key: value for key, value in rollup.items() if key not in ('calls', 'errors') and key not in COUNTER_FIELDS}
+        update['calls'] = firestore.Increment(rollup['calls'])
+        update['errors'] = firestore.Increment(rollup['errors'])
+        for field in COUNTER_FIELDS:
+            update[field] = firestore.Increment(rollup[field])
+        update['last_updated'] = firestore.SERVER_TIMESTAMP
+        batch.set(db.collection(ROLLUP_COLLECTION).document(rollup_id), update, merge=True)
+    batch.commit()
+
+
+def flush():
+    """Writes all buffered entries now. Entries are put back if the write fails."""
+    while True:
+        with _lock:
+            entries = [_buffer.popleft() for _ in range(min(FLUSH_BATCH_SIZE, len(_buffer)))]
+        if not entries:
+            return
+        try:
+            _write(entries)
+        except Exception as e:
+            print(f"Warning: usage ledger flush failed, keeping {len(entries)} entries buffered: {e}")
+            with _lock:
+                _buffer.extendleft(reversed(entries))
+            return
+
+
+def _run_flusher():
+    while True:
+        _wake.wait(FLUSH_INTERVAL_SEC)
+        _wake.clear()
+        flush()
+
+
+def _ensure_flusher():
+    global _flusher
+    if _flusher is not None and _flusher.is_alive():
+        return
+    with _lock:
+        if _flusher is None or not _flusher.is_alive():
+            _flusher = threading.Thread(target=_run_flusher, name='usage-ledger', daemon=True)
+            _flusher.start()
+
+
+atexit.register(flush)
@@ -0,0 +1,179 @@
+"""Instance warm-up and per-instance prepared state.
+
+Builds the objects every handler needs (Firebase app, provider clients, dynamic
+config, response schemas, Gemini GenerateContentConfig objects and Gemini
+prompt caches) once per
+instance and caches them, so the first user request after a deploy or scale-out
+does not pay for them. `warm_up()` runs every step ahead of time and reports
+how long each one took.
+"""
+
+import copy
+import os
+import threading
+import time
+import firebase_admin
+from openai import OpenAI
+import instructor
+from google import genai
+from google.genai import types as genai_types
+from config_helper import get_cached_config
+import prompt_cache
+from models import ReceiptData, AssignmentResult
+
+SERVICES = ('parse_receipt', 'assign_people_to_items', 'transcribe_audio')
+# Structured-output response model of each service
+SERVICE_RESPONSE_MODELS = {
+    'parse_receipt': ReceiptData,
+    'assign_people_to_items': AssignmentResult,
+}
+GEMINI_THINKING_BUDGET = 8000
+
+_lock = threading.RLock() # Re-entrant: get_generation_config builds the schema while holding it
+_openai_clients = {} # patched (bool) -> client
+_gemini_client = None
+_response_schemas = {} # Pydantic model class -> JSON schema dict
+_generation_configs = {} # Pydantic model class -> GenerateContentConfig
+
+
+def ensure_firebase_app():
+    """Initializes the default Firebase app if this process has not done so yet."""
+    try:
+        return firebase_admin.get_app()
+    except ValueError:
+        return firebase_admin.initialize_app()
+
+
+def get_openai_client(patched=False):
+    """Returns the cached OpenAI client, optionally patched with Instructor."""
+    with _lock:
+        client = _openai_clients.get(patched)
+        if client is None:
+            openai_api_key = os.environ.get('OPENAI_API_KEY')
+            if not openai_api_key:
+                raise ValueError("OpenAI API key secret ('OPENAI_API_KEY') not found.")
+            # Retries are scheduled by rate_limiter.limited_call, not by the SDK
+            client = OpenAI(api_key=openai_api_key, max_retries=0)
+            if patched:
+                client = instructor.from_openai(client)
+            _openai_clients[patched] = client
+        return client
+
+
+def get_gemini_client():
+    """Returns the cached google.genai client."""
+    global _gemini_client
+    with _lock:
+        if _gemini_client is None:
+            google_api_key = os.environ.get('GOOGLE_API_KEY')
+            if not google_api_key:
+                raise ValueError("Google API key secret ('GOOGLE_API_KEY') not found.")
+            _gemini_client = genai.Client(api_key=google_api_key)
+        return _gemini_client
+
+
+def get_response_schema(model):
+    """Returns the JSON schema of a Pydantic model, generated once per instance. Callers must not modify it."""
+    with _lock:
+        schema = _response_schemas.get(model)
+        if schema is None:
+            schema = model.model_json_schema()
+            _response_schemas[model] = schema
+        return schema
+
+
+def get_generation_config(response_model):
+    """Returns a Gemini GenerateContentConfig for structured output matching a Pydantic model.
+
+    The config is built once per instance, but each call gets a copy with its own response_schema dict:
+    google-genai rewrites the schema in place when it sends a request (pops '$defs', inlines '$ref'),
+    so concurrent requests must never share one.
+    """
+    with _lock:
+        generation_config = _generation_configs.get(response_model)
+        if generation_config is None:
+            generation_config = genai_types.GenerateContentConfig(
+                response_mime_type="application/json",
+                response_schema=get_response_schema(response_model), # JSON schema generated once instead of per call
+                thinking_config=genai_types.ThinkingConfig(thinking_budget=GEMINI_THINKING_BUDGET)
+            )
+            _generation_configs[response_model] = generation_config
+        schema = copy.deepcopy(generation_config.response_schema)
+    return generation_config.model_copy(update={"response_schema": schema})
+
+
+def _timed(timings, step, func):
+    """Runs func, storing its duration in milliseconds under timings[step]. Errors are recorded, not raised."""
+    started = time.perf_counter()
+    try:
+        return func()
+    except Exception as e:
+        timings.setdefault('errors', {})[step] = f"{type(e).__name__}: {e}"
+        print(f"Warm-up step '{step}' failed: {e}")
+    finally:
+        timings[step] = round((time.perf_counter() - started) * 1000, 2)
+
+
+def warm_up(services=SERVICES, import_seconds=None):
+    """Prepares and caches everything the given services need, returning per-step timings in milliseconds.
+
+    Args:
+        services (iterable): Service names to prepare config and schemas for.
+        import_seconds (float): Optional module import time measured by the caller, reported as 'imports'.
+
+    Returns:
+        dict: Step name -> duration in ms, plus 'total' and an 'errors' map for steps that failed.
+    """
+    started = time.perf_counter()
+    timings = {}
+    if import_seconds is not None:
+        timings['imports'] = round(import_seconds * 1000, 2)
+
+    _timed(timings, 'firebase_app', ensure_firebase_app)
+
+    configs = {}
+    def fetch_configs():
+        for service_name in services:
+            configs[service_name] = get_cached_config(service_name)
+        fallbacks = [name for name, config in configs.items() if config.get('fallback')]
+        if fallbacks:
+            raise RuntimeError(f"Firestore config could not be read, using fallback defaults for {fallbacks}")
+    _timed(timings, 'config', fetch_configs)
+
+    # Only build clients for providers that are actually selected
+    openai_services = [name for name, config in configs.items() if config.get('provider_name') == 'openai']
+    if openai_services:
+        def build_openai_clients():
+            if 'transcribe_audio' in openai_services:
+                get_openai_client()
+            if any(name != 'transcribe_audio' for name in openai_services):
+                get_openai_client(patched=True) # Instructor-patched client for structured output
+        _timed(timings, 'openai_client', build_openai_clients)
+    if any(config.get('provider_name') == 'gemini' for config in configs.values()):
+        _timed(timings, 'gemini_client', get_gemini_client)
+
+    response_models = [SERVICE_RESPONSE_MODELS[name] for name in services if name in SERVICE_RESPONSE_MODELS]
+    _timed(timings, 'schemas', lambda: [get_response_schema(model) for model in response_models])
+    _timed(timings, 'generation_configs', lambda: [get_generation_config(model) for model in response_models])
+
+    # Gemini context caches for the static prompts, so the first request already references one
+    gemini_prompts = [
+        (name, config) for name, config in configs.items()
+        if config.get('provider_name') == 'gemini' and name in SERVICE_RESPONSE_MODELS and config.get('prompt')
+    ]
+    if gemini_prompts:
+        _timed(timings, 'prompt_caches', lambda: [
+            prompt_cache.get_cache_name(get_gemini_client(), name, config.get('model'), config['prompt'], config.get('prompt_version'))
+            for name, config in gemini_prompts
+        ])
+
+    timings['total'] = round((time.perf_counter() - started) * 1000, 2)
+    print(f"Warm-up complete for {list(services)}: {timings}")
+    return timings
+
+
+def warm_up_in_background(services=SERVICES, import_seconds=None):
+    """Starts warm_up() on a daemon thread, e.g. at min-instance startup, without blocking module import."""
+    thread = threading.Thread(target=warm_up, args=(services, import_seconds), name='warm-up', daemon=True)
+    thread.start()
+    return thread